@@ -0,0 +1,259 @@
+import os
+import re
+import glob
+import datetime
+import numpy as np
+import STATS_operations
+
+# BigQuery tables read by the DAISY and MDSLP workflows
+workflow_tables = [
+    'syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels',
+    'syntheticlethality.DepMap_public_20Q3.CCLE_mutation',
+    'syntheticlethality.DepMap_public_20Q3.CCLE_gene_expression',
+    'syntheticlethality.DepMap_public_20Q3.CCLE_gene_cn',
+    'syntheticlethality.DepMap_public_20Q3.Achilles_gene_effect',
+    'syntheticlethality.DEMETER2_v6.D2_combined_gene_dep_score',
+    'syntheticlethality.gene_information.gene_info_human',
+    'isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp',
+    'isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene',
+    'isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample'
+]
+
+# persistent UDFs referenced by their BigQuery path
+udf_paths = {
+    '`cgc-05-0042.functions.jstat_normal_cdf`': 'jstat_normal_cdf'
+}
+
+
+def MirrorTables(bq_client, data_dir, tables=None):
+    '''
+    Copies BigQuery tables into <data_dir>/<project>/<dataset>/<table>.parquet
+    so that LocalClient can run the workflows without network access.
+    Tables that are already mirrored are skipped.
+    '''
+    import pyarrow.parquet as pq
+
+    if tables is None:
+        tables = workflow_tables
+    for table in tables:
+        project, dataset, table_name = table.split('.')
+        out_file = os.path.join(data_dir, project, dataset, table_name + '.parquet')
+        if os.path.exists(out_file):
+            print(table + " is already mirrored")
+            continue
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        data = bq_client.list_rows(table).to_arrow()
+        pq.write_table(data, out_file + '.tmp')
+        os.replace(out_file + '.tmp', out_file)
+        print(table + " mirrored into " + out_file)
+
+
+def StripComments(sql):
+    '''
+    Removes BigQuery '#' comments outside of string literals
+    '''
+    out = []
+    quote = None
+    in_comment = False
+    for ch in sql:
+        if in_comment:
+            if ch == '\n':
+                in_comment = False
+                out.append(ch)
+            continue
+        if quote is None and ch == '#':
+            in_comment = True
+            continue
+        if quote is None and ch in ("'", '"', '`'):
+            quote = ch
+        elif ch == quote:
+            quote = None
+        out.append(ch)
+    return(''.join(out))
+
+
+def TranslateSQL(sql, tables):
+    '''
+    Rewrites the BigQuery standard SQL used in SL-Cloud into DuckDB SQL:
+    JavaScript temporary functions are dropped (their local equivalents are
+    registered on the connection), comments and double quoted literals are
+    converted, table paths are mapped to the mirrored views and @parameters
+    to DuckDB $parameters.
+    '''
+    sql = re.sub(r'CREATE\s+TEMPORARY\s+FUNCTION\s+\w+.*?OPTIONS\s*\(.*?\)\s*;', '', sql, flags=re.S | re.I)
+    sql = StripComments(sql)
+    for udf_path, local_name in udf_paths.items():
+        sql = sql.replace(udf_path, local_name)
+    sql = re.sub(r'=\s*"([^"]*)"', r"='\1'", sql)
+
+    def quote_table(match):
+        if match.group(1) in tables:
+            return('"' + match.group(1) + '"')
+        return(match.group(0))
+    sql = re.sub(r'`([\w-]+\.\w+\.\w+)`', quote_table, sql)
+    sql = re.sub(r'(?<![\w".`-])([A-Za-z][\w-]*\.\w+\.\w+)(?![\w"`.])', quote_table, sql)
+
+    sql = re.sub(r'\bSQRT\s*\(', 'bq_sqrt(', sql, flags=re.I)
+    sql = re.sub(r'\bIS_NAN\s*\(', 'isnan(', sql, flags=re.I)
+    sql = re.sub(r'\bin\s+UNNEST\s*\(\s*@(\w+)\s*\)', r'IN (SELECT UNNEST($\1))', sql, flags=re.I)
+    sql = re.sub(r'@(\w+)', r'$\1', sql)
+    return(sql)
+
+
+def arrow_udf(function):
+    '''
+    Wraps a numpy function of three float arrays as a vectorized DuckDB UDF,
+    NaN results stay NaN as in the BigQuery UDFs
+    '''
+    import pyarrow as pa
+
+    def to_numpy(array):
+        return(np.asarray(array.to_pandas(), dtype=float))
+
+    def udf(a, b, c):
+        return(pa.array(function(to_numpy(a), to_numpy(b), to_numpy(c))))
+    return(udf)
+
+
+class LocalQueryJob:
+    '''
+    Mimics the part of bigquery.QueryJob used by SL-Cloud:
+    client.query(sql, job_config).result().to_dataframe() (or to_arrow(),
+    to_arrow_iterable()) and its statistics: total_bytes_processed is the
+    Parquet size of the tables the query reads, a dry run
+    (job_config.dry_run) only sets it
+    '''
+
+    def __init__(self, client, sql, job_config=None):
+        self.client = client
+        self.query = sql
+        self.job_config = job_config
+        self.data = None
+        self.table = None
+        self.cursor = None
+        self.job_id = None
+        self.cache_hit = False
+        self.slot_millis = None
+        self.total_bytes_billed = None
+        self.created = datetime.datetime.now(datetime.timezone.utc)
+        self.started = None
+        self.ended = None
+        self.sql = TranslateSQL(self.query, self.client.tables)
+        self.total_bytes_processed = sum(size for table, size in self.client.table_bytes.items()
+                                         if '"' + table + '"' in self.sql)
+
+    def execute(self):
+        params = {}
+        if self.job_config is not None:
+            for param in getattr(self.job_config, 'query_parameters', []):
+                params[param.name] = list(param.values) if hasattr(param, 'values') else param.value
+        cursor = self.client.con.cursor()
+        try:
+            cursor.execute(self.sql, params)
+        except Exception:
+            cursor.close()
+            raise
+        return(cursor)
+
+    def result(self):
+        if self.cursor is None and self.data is None and self.table is None and not getattr(self.job_config, 'dry_run', False):
+            self.started = datetime.datetime.now(datetime.timezone.utc)
+            self.cursor = self.execute()
+            self.ended = datetime.datetime.now(datetime.timezone.utc)
+        return(self)
+
+    def take_cursor(self):
+        '''
+        Cursor holding the rows of the query, executed again if an earlier
+        fetch consumed them
+        '''
+        self.result()
+        cursor, self.cursor = self.cursor, None
+        if cursor is None:
+            cursor = self.execute()
+        return(cursor)
+
+    def to_dataframe(self, **kwargs):
+        if self.data is None and not getattr(self.job_config, 'dry_run', False):
+            cursor = self.take_cursor()
+            try:
+                self.data = cursor.df()
+            finally:
+                cursor.close()
+        return(self.data)
+
+    def to_arrow(self, **kwargs):
+        if self.table is None and not getattr(self.job_config, 'dry_run', False):
+            cursor = self.take_cursor()
+            try:
+                self.table = cursor.fetch_arrow_table()
+            finally:
+                cursor.close()
+        return(self.table)
+
+    def to_arrow_iterable(self, batch_rows=100000, **kwargs):
+        cursor = self.take_cursor()
+        try:
+            for batch in cursor.fetch_record_batch(batch_rows):
+                yield(batch)
+        finally:
+            cursor.close()
+
+
+class LocalClient:
+    '''
+    Stand-in for bigquery.Client running the workflow queries with DuckDB on
+    Parquet mirrors of the BigQuery tables (see MirrorTables). A table
+    project.dataset.table is read from <data_dir>/<project>/<dataset>/<table>.parquet
+    or from all Parquet files in the <data_dir>/<project>/<dataset>/<table>/ folder.
+    '''
+
+    def __init__(self, data_dir, threads=None):
+        import duckdb
+
+        self.data_dir = data_dir
+        self.con = duckdb.connect()
+        if threads is not None:
+            self.con.execute("SET threads=" + str(int(threads)))
+        self.con.execute("CREATE MACRO bq_sqrt(x) AS CASE WHEN x < 0 THEN NULL ELSE sqrt(x) END")
+        #NULL in and out as in BigQuery, e.g. the p-value of a NaN correlation
+        self.con.create_function('tscore_to_p', arrow_udf(STATS_operations.tscore_to_p),
+                                 ['DOUBLE', 'DOUBLE', 'DOUBLE'], 'DOUBLE', type='arrow', null_handling='special')
+        self.con.create_function('jstat_normal_cdf', arrow_udf(STATS_operations.jstat_normal_cdf),
+                                 ['DOUBLE', 'DOUBLE', 'DOUBLE'], 'DOUBLE', type='arrow', null_handling='special')
+
+        self.tables = set()
+        self.table_bytes = {}
+        for path in glob.glob(os.path.join(data_dir, '*', '*', '*')):
+            project, dataset, table_name = os.path.relpath(path, data_dir).split(os.sep)
+            if os.path.isdir(path):
+                source = os.path.join(path, '*.parquet')
+            elif path.endswith('.parquet'):
+                table_name = table_name[:-len('.parquet')]
+                source = path
+            else:
+                continue
+            table = project + '.' + dataset + '.' + table_name
+            self.table_bytes[table] = sum(os.path.getsize(f) for f in glob.glob(source))
+            self.con.execute('CREATE VIEW "' + table + '" AS SELECT * FROM read_parquet(\'' +
+                             source.replace("'", "''") + '\')')
+            self.tables.add(table)
+
+    def query(self, sql, job_config=None, **kwargs):
+        return(LocalQueryJob(self, sql, job_config))
+
+
+def GetClient(backend='bigquery', project_id='syntheticlethality', data_dir=None, threads=None):
+    '''
+    Returns a BigQuery client or, with backend='local', a LocalClient on the
+    mirrored tables in data_dir. Both can be passed to the DAISY functions,
+    helper.ConvertGene and MDSLP.set_client.
+    '''
+    if backend == 'bigquery':
+        from google.cloud import bigquery
+        return(bigquery.Client(project_id))
+    elif backend == 'local':
+        return(LocalClient(data_dir, threads))
+    else:
+        print("Backend can be either bigquery or local")
+        return()
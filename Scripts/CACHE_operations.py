@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import Future
+import pandas as pd
+
+cache_settings = {
+    'cache_dir': os.environ.get('SL_CLOUD_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'sl-cloud')),
+    'max_bytes': int(os.environ.get('SL_CLOUD_CACHE_MAX_BYTES', 20 * 1024**3)),
+    'persist_queries': os.environ.get('SL_CLOUD_PERSIST_QUERIES', '0') == '1'
+}
+
+figshare_url = 'https://ndownloader.figshare.com/files/__FILE_ID__'
+figshare_api_url = 'https://api.figshare.com/v2/articles/__ARTICLE_ID__/versions/__VERSION__'
+
+# serializes the manifest updates of concurrent callers
+cache_lock = threading.RLock()
+
+
+def SetCacheDir(cache_dir, max_bytes=None):
+    '''
+    Changes the local cache directory and optionally its size cap in bytes
+    '''
+    cache_settings['cache_dir'] = cache_dir
+    if max_bytes is not None:
+        cache_settings['max_bytes'] = max_bytes
+
+
+def ReadManifest():
+    '''
+    The manifest maps cache keys to content addressed files under blobs/
+    together with their checksum, size, modification time and last use time
+    '''
+    manifest_file = os.path.join(cache_settings['cache_dir'], 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return({})
+    with open(manifest_file) as f:
+        return(json.load(f))
+
+
+def WriteManifest(manifest):
+    os.makedirs(cache_settings['cache_dir'], exist_ok=True)
+    manifest_file = os.path.join(cache_settings['cache_dir'], 'manifest.json')
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def FileChecksum(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return(sha.hexdigest())
+
+
+def AddBlob(key, tmp_file, sha256, suffix=''):
+    '''
+    Moves a finished temporary file to blobs/<sha256><suffix>, records it
+    under key in the manifest and applies the size cap
+    '''
+    with cache_lock:
+        blob_dir = os.path.join(cache_settings['cache_dir'], 'blobs')
+        os.makedirs(blob_dir, exist_ok=True)
+        blob_name = sha256 + suffix
+        os.replace(tmp_file, os.path.join(blob_dir, blob_name))
+        stat = os.stat(os.path.join(blob_dir, blob_name))
+        manifest = ReadManifest()
+        manifest[key] = {'blob': blob_name,
+                         'sha256': sha256,
+                         'size': stat.st_size,
+                         'mtime': stat.st_mtime,
+                         'last_used': time.time()}
+        WriteManifest(manifest)
+        EvictCache(keep=[key])
+        return(os.path.join(blob_dir, blob_name))
+
+
+def GetBlob(key, verify=False):
+    '''
+    Returns the path of the cached file stored under key or None if it is not
+    cached or fails the validation. Blobs are hashed when they are added, a
+    load only checks the size and modification time recorded then and hashes
+    the file again when the time changed or verify=True. The hash is computed
+    outside cache_lock.
+    '''
+    with cache_lock:
+        entry = ReadManifest().get(key)
+    if entry is None:
+        return(None)
+    path = os.path.join(cache_settings['cache_dir'], 'blobs', entry['blob'])
+    stat = os.stat(path) if os.path.exists(path) else None
+    valid = stat is not None and stat.st_size == entry['size']
+    if valid and (verify or stat.st_mtime != entry.get('mtime')):
+        valid = FileChecksum(path) == entry['sha256']
+
+    with cache_lock:
+        manifest = ReadManifest()
+        if manifest.get(key, {}).get('blob') != entry['blob']:
+            return(GetBlob(key, verify))
+        if not valid:
+            print("Cached file for " + key + " is missing or corrupted, it will be fetched again")
+            RemoveCacheEntry(key)
+            return(None)
+        manifest[key]['mtime'] = stat.st_mtime
+        manifest[key]['last_used'] = time.time()
+        WriteManifest(manifest)
+        return(path)
+
+
+def RemoveCacheEntry(key):
+    '''
+    Drops key from the manifest, its blob is deleted when no other key uses it
+    '''
+    with cache_lock:
+        manifest = ReadManifest()
+        entry = manifest.pop(key, None)
+        if entry is None:
+            return()
+        WriteManifest(manifest)
+        if all(other['blob'] != entry['blob'] for other in manifest.values()):
+            path = os.path.join(cache_settings['cache_dir'], 'blobs', entry['blob'])
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def EvictCache(max_bytes=None, keep=()):
+    '''
+    Removes the least recently used entries until the blobs fit in max_bytes
+    (the configured cap by default), the keys in keep are never evicted
+    '''
+    with cache_lock:
+        if max_bytes is None:
+            max_bytes = cache_settings['max_bytes']
+        manifest = ReadManifest()
+        blob_sizes = {entry['blob']: entry['size'] for entry in manifest.values()}
+        total = sum(blob_sizes.values())
+        for key in sorted(manifest, key=lambda k: manifest[k]['last_used']):
+            if total <= max_bytes:
+                break
+            if key in keep:
+                continue
+            blob = manifest[key]['blob']
+            RemoveCacheEntry(key)
+            if blob not in [entry['blob'] for entry in ReadManifest().values()]:
+                total = total - blob_sizes[blob]
+
+
+def ClearCache():
+    for key in list(ReadManifest()):
+        RemoveCacheEntry(key)
+
+
+def FigshareMD5(file_id, article):
+    '''
+    figshare's computed_md5 of file_id in the files of article, an
+    (article id, version) pair of a public figshare dataset
+    '''
+    import requests
+
+    url = figshare_api_url.replace('__ARTICLE_ID__', str(article[0])).replace('__VERSION__', str(article[1]))
+    req = requests.get(url)
+    req.raise_for_status()
+    for item in req.json()['files']:
+        if item['id'] == int(file_id):
+            return(item['computed_md5'])
+    raise ValueError('figshare file ' + str(file_id) + ' is not part of article ' + str(article[0]) + ' version ' + str(article[1]))
+
+
+def FetchFigshareFile(file_id, expected_md5=None, chunk_size=1 << 22, article=None):
+    '''
+    Returns the local path of a figshare file, downloading it in chunks
+    straight to disk the first time. expected_md5 (figshare's computed_md5)
+    is checked when given, with article it is looked up before a download.
+    When the lookup fails the file is downloaded without the check.
+    '''
+    import requests
+
+    key = 'figshare/' + str(file_id)
+    path = GetBlob(key)
+    if path is not None:
+        return(path)
+    if expected_md5 is None and article is not None:
+        try:
+            expected_md5 = FigshareMD5(file_id, article)
+        except Exception as error:
+            print("Could not look up the checksum of figshare file " + str(file_id) + " (" + str(error) +
+                  "), downloading it without the check")
+
+    os.makedirs(cache_settings['cache_dir'], exist_ok=True)
+    tmp_file = os.path.join(cache_settings['cache_dir'], 'download_' + str(file_id) + '_' + str(threading.get_ident()) + '.tmp')
+    sha = hashlib.sha256()
+    md5 = hashlib.md5()
+    url = figshare_url.replace('__FILE_ID__', str(file_id))
+    try:
+        with requests.get(url, stream=True) as req:
+            req.raise_for_status()
+            with open(tmp_file, 'wb') as f:
+                for chunk in req.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    sha.update(chunk)
+                    md5.update(chunk)
+
+        if expected_md5 is not None and md5.hexdigest() != expected_md5:
+            raise ValueError('Checksum mismatch for figshare file ' + str(file_id))
+        return(AddBlob(key, tmp_file, sha.hexdigest()))
+    finally:
+        #AddBlob moved the file away unless the download or the check failed
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def StoreFrame(key, data):
+    '''
+    Saves a dataframe under key as Parquet, or as a pickle when pyarrow is not
+    installed
+    '''
+    os.makedirs(cache_settings['cache_dir'], exist_ok=True)
+    tmp_file = os.path.join(cache_settings['cache_dir'], 'frame_' + hashlib.sha256(key.encode()).hexdigest() +
+                            '_' + str(threading.get_ident()) + '.tmp')
+    try:
+        import pyarrow
+        data.to_parquet(tmp_file)
+        suffix = '.parquet'
+    except ImportError:
+        data.to_pickle(tmp_file)
+        suffix = '.pkl'
+    return(AddBlob(key, tmp_file, FileChecksum(tmp_file), suffix))
+
+
+def LoadFrame(key):
+    '''
+    Returns the dataframe stored under key or None
+    '''
+    path = GetBlob(key)
+    if path is None:
+        return(None)
+    if path.endswith('.parquet'):
+        return(pd.read_parquet(path))
+    return(pd.read_pickle(path))
+
+
+# results of release-static reference queries, keyed by (release, name), as
+# futures so that concurrent callers of a missing query wait for one run
+query_cache = {}
+query_cache_lock = threading.Lock()
+
+
+def CachedQuery(client, name, sql, release, persist=None):
+    '''
+    Runs a query whose result only changes with the dataset release once per
+    process. With persist_queries set (SetQueryPersistence) or persist=True the
+    result is also kept on disk under the release, so new sessions skip it too.
+    '''
+    if persist is None:
+        persist = cache_settings['persist_queries']
+    memo_key = (release, name)
+    with query_cache_lock:
+        future = query_cache.get(memo_key)
+        owner = future is None
+        if owner:
+            future = Future()
+            query_cache[memo_key] = future
+    if owner:
+        try:
+            disk_key = 'query/' + release + '/' + name
+            data = None
+            if persist:
+                data = LoadFrame(disk_key)
+            if data is None:
+                data = client.query(sql).result().to_dataframe()
+                if persist:
+                    StoreFrame(disk_key, data)
+        except BaseException as error:
+            with query_cache_lock:
+                if query_cache.get(memo_key) is future:
+                    del query_cache[memo_key]
+            future.set_exception(error)
+            raise
+        future.set_result(data)
+    return(future.result().copy())
+
+
+def SetQueryPersistence(persist):
+    cache_settings['persist_queries'] = persist
+
+
+def ClearQueryCache(release=None, disk=False, name=None):
+    '''
+    Invalidates the memoized reference queries of one release (all releases
+    by default) or only the query name of it, disk=True also removes their
+    on-disk copies
+    '''
+    with query_cache_lock:
+        for memo_key in list(query_cache):
+            if (release is None or memo_key[0] == release) and (name is None or memo_key[1] == name):
+                del query_cache[memo_key]
+    if disk:
+        prefix = 'query/' if release is None else 'query/' + release + '/'
+        for key in list(ReadManifest()):
+            if key.startswith(prefix) and (name is None or key.split('/')[-1] == name):
+                RemoveCacheEntry(key)
@@ -0,0 +1,339 @@
+'''
+Local engines for the DAISY inference procedures: the long data tables are
+fetched once and the statistics the SQL queries compute with window
+functions and self joins are done with NumPy. The per gene ranks of the
+large tables are materialized on disk per (table, release, sample set) and
+reused by later calls with the same cohort.
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import STATS_operations
+import CACHE_operations
+import QUERY_operations
+from helper import CompileQuery, ListParameters
+
+rank_table_settings = {
+    'memory_tables': 4
+}
+
+# recently used rank tables, keyed by their cache key
+rank_tables = OrderedDict()
+rank_table_lock = threading.Lock()
+
+values_sql = '''
+    SELECT __GENE_SYMBOL__ AS symbol, __SAMPLE_ID__ AS Barcode, __VALUE__ AS data
+    FROM `__TABLE_NAME__`
+    WHERE __GENE_SYMBOL__ IS NOT NULL AND __VALUE__ IS NOT NULL AND __SAMPLE_ID__ IN UNNEST(@samples)
+    '''
+
+input_values_sql = values_sql + ' AND __GENE_SYMBOL__ IN UNNEST(@input_genes)'
+
+averaged_sql = '''
+    SELECT __GENE_SYMBOL__ AS symbol, __SAMPLE_ID__ AS Barcode, AVG(__VALUE__) AS data
+    FROM `__TABLE_NAME__`
+    WHERE __GENE_SYMBOL__ IS NOT NULL AND __VALUE__ IS NOT NULL AND __SAMPLE_ID__ IN UNNEST(@samples)
+    GROUP BY __SAMPLE_ID__, __GENE_SYMBOL__
+    '''
+
+effect_sql = '''
+    SELECT A.__GENE_SYMBOL__ AS symbol, S.DepMap_ID AS Barcode, A.__VALUE__ AS data
+    FROM `__TABLE_NAME__` A, `__SAMPLE_INFO_TABLE__` S
+    WHERE A.__GENE_SYMBOL__ IS NOT NULL AND A.__VALUE__ IS NOT NULL
+          AND S.__REL_SAMPLE_ID__ = A.__SAMPLE_ID__ AND S.DepMap_ID IN UNNEST(@samples)
+    '''
+
+# dtype plan of the fetched rows, gene symbols and sample IDs as categories
+row_dtypes = {'symbol': 'category', 'Barcode': 'category'}
+
+mutations_sql = '''
+    SELECT __GENE_SYMBOL__ AS symbol, __SAMPLE_ID__ AS Barcode
+    FROM `__TABLE_NAME__`
+    WHERE __GENE_SYMBOL__ IN UNNEST(@input_genes) AND Variant_Classification IN UNNEST(@mutations)
+          AND __SAMPLE_ID__ IN UNNEST(@samples) __FILTER__
+    '''
+
+
+def FetchRows(client, template, replacements, **lists):
+    '''
+    Runs a row selection template with the lists as array parameters
+    '''
+    sql = CompileQuery(template, replacements)
+    return(QUERY_operations.FetchFrame(client.query(sql, job_config=ListParameters(**lists)), row_dtypes))
+
+
+def SampleSetHash(samples):
+    return(hashlib.sha256('\n'.join(sorted(set(str(x) for x in samples))).encode()).hexdigest())
+
+
+def RankTable(client, template, replacements, table_name, samples):
+    '''
+    (symbol, Barcode, data, rank) rows of a row selection template over the
+    samples, rank being the per gene rank with ties averaged
+    (RANK() + (ties - 1)/2 in the queries), kept as float32 which holds the
+    half integer ranks exactly. The table is materialized in the
+    local cache under ranks/<release>/<table>/<hash of query and sample set>,
+    where it is subject to the cache size cap and LRU eviction, and the last
+    rank_table_settings['memory_tables'] tables are kept in memory.
+    '''
+    sql = CompileQuery(template, replacements)
+    release = table_name.split('.')[-2]
+    key = 'ranks/' + release + '/' + table_name + '/' + SampleSetHash([sql] + [str(x) for x in samples])
+    with rank_table_lock:
+        if key in rank_tables:
+            rank_tables.move_to_end(key)
+            return(rank_tables[key])
+
+    data = CACHE_operations.LoadFrame(key)
+    if data is None:
+        data = QUERY_operations.FetchFrame(client.query(sql, job_config=ListParameters(samples=samples)), row_dtypes)
+        data = data[['symbol', 'Barcode', 'data']]
+        data['rank'] = data.groupby('symbol', observed=True)['data'].rank(method='average').astype(np.float32)
+        CACHE_operations.StoreFrame(key, data)
+    with rank_table_lock:
+        rank_tables[key] = data
+        while len(rank_tables) > rank_table_settings['memory_tables']:
+            rank_tables.popitem(last=False)
+    return(data)
+
+
+def ClearRankTables(disk=False):
+    '''
+    Drops the in memory rank tables, disk=True also removes the materialized ones
+    '''
+    rank_tables.clear()
+    if disk:
+        for key in list(CACHE_operations.ReadManifest()):
+            if key.startswith('ranks/'):
+                CACHE_operations.RemoveCacheEntry(key)
+
+
+def RankMatrix(rank_rows):
+    '''
+    Sample x gene float32 matrix of the ranks of a rank table with one row per
+    (sample, gene), NaN where a gene has no value. Genes are sorted.
+    '''
+    sample_codes, sample_index = pd.factorize(rank_rows['Barcode'])
+    gene_codes, genes = pd.factorize(rank_rows['symbol'], sort=True)
+    matrix = np.full((len(sample_index), len(genes)), np.nan, dtype=np.float32)
+    matrix[sample_codes, gene_codes] = rank_rows['rank'].values
+    return(matrix, np.asarray(genes, dtype=object), np.asarray(sample_index, dtype=object))
+
+
+def ShiftedRanks(ranks):
+    '''
+    Doubled ranks of a block of rank columns shifted by their rounded mean,
+    integers in float64 with 0 where a rank is missing, and the mask of the
+    present ranks
+    '''
+    mask = ~np.isnan(ranks)
+    doubled = 2 * ranks.astype(float)
+    doubled[~mask] = 0
+    doubled -= np.round(doubled.sum(axis=0) / np.maximum(mask.sum(axis=0), 1))
+    doubled[~mask] = 0
+    return(doubled, mask)
+
+
+def RankCorrelations(ranks, columns_a, columns_b, column_block=1024):
+    '''
+    Pairwise complete Pearson correlation of the rank columns columns_a with
+    columns_b (CORR over the common samples) and the number of common
+    samples. Ranks are half integers, doubled and shifted to integers all
+    sums are exact, so constant pairs give NaN as in SQL. columns_b is
+    processed column_block columns at a time, so the float64 temporaries
+    are bounded by samples x column_block whatever the number of genes.
+    '''
+    x, x_mask = ShiftedRanks(ranks[:, columns_a])
+    x_mask = x_mask.astype(float)
+    xx = x * x
+    columns_b = np.asarray(columns_b)
+    correlation = np.empty((len(columns_a), len(columns_b)))
+    n = np.empty((len(columns_a), len(columns_b)))
+    for start in range(0, len(columns_b), column_block):
+        block = slice(start, start + column_block)
+        y, y_mask = ShiftedRanks(ranks[:, columns_b[block]])
+        y_mask = y_mask.astype(float)
+        n_block = x_mask.T @ y_mask
+        sum_x = x.T @ y_mask
+        sum_xx = xx.T @ y_mask
+        sum_xy = x.T @ y
+        sum_y = x_mask.T @ y
+        y *= y
+        sum_yy = x_mask.T @ y
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var_prod = (n_block * sum_xx - sum_x * sum_x) * (n_block * sum_yy - sum_y * sum_y)
+            correlation[:, block] = np.where(var_prod > 0, (n_block * sum_xy - sum_x * sum_y) / np.sqrt(var_prod), np.nan)
+        n[:, block] = n_block
+    return(correlation, n)
+
+
+def CoexpressionResults(client, table_name, gene_col_name, exp_name, sample_barcode, input_genes, selected_samples, min_sample_size=20):
+    '''
+    Local engine of CoexpressionAnalysis: Spearman correlation of every input
+    gene with every other gene of table_name over the selected samples.
+    Returns the columns of the coexpression query (symbol1, symbol2, n,
+    correlation, pvalue) for the input x non input gene pairs and the input
+    gene pairs with symbol1 < symbol2 that share more than min_sample_size
+    samples, sorted by symbol1 and decreasing correlation.
+    '''
+    rank_rows = RankTable(client, averaged_sql, [('__TABLE_NAME__', table_name), ('__GENE_SYMBOL__', gene_col_name),
+                                                 ('__VALUE__', exp_name), ('__SAMPLE_ID__', sample_barcode)],
+                          table_name, selected_samples)
+    ranks, genes, samples = RankMatrix(rank_rows)
+
+    is_input = np.isin(genes, [str(x) for x in input_genes])
+    columns_a = np.flatnonzero(is_input)
+    correlation, n = RankCorrelations(ranks, columns_a, np.arange(len(genes)))
+
+    symbol1 = genes[columns_a][:, None]
+    keep = (~is_input[None, :] | (symbol1 < genes[None, :])) & (n > min_sample_size)
+    rows, cols = np.nonzero(keep)
+    n = n[rows, cols]
+    correlation = correlation[rows, cols]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tscore = np.abs(correlation) * np.sqrt((n - 2) / ((1 + correlation) * (1 - correlation)))
+    results = pd.DataFrame({'symbol1': genes[columns_a][rows],
+                            'symbol2': genes[cols],
+                            'n': n.astype(int),
+                            'correlation': correlation,
+                            'pvalue': STATS_operations.tscore_to_p(tscore, n - 2, 2)})
+    results = results.sort_values(['symbol1', 'correlation'], ascending=[True, False], kind='mergesort')
+    return(results.reset_index(drop=True))
+
+
+def MannWhitneyResults(inactive_pairs, rank_rows, direction, min_sample_size=20, min_inactive=5, candidate_block=2048):
+    '''
+    Mann-Whitney U test of every (inactive gene, candidate) pair as in the
+    SurvivalOfFittest and FunctionalExamination queries. inactive_pairs holds
+    the distinct (symbol, Barcode) inactive samples of the input genes,
+    rank_rows the (symbol, Barcode, rank) rows of the candidates (RankTable).
+    Per block of candidates n_1 = inactive_mask.T @ row_counts and
+    sumx_1 = inactive_mask.T @ rank_sums. direction=-1 gives
+    z = (n1n2/2 - U1)/den (SoF), +1 gives (U1 - n1n2/2)/den. Pairs need
+    n_t > min_sample_size, n_1 > min_inactive and den > 0.
+    '''
+    ranks = rank_rows['rank'].values
+    sample_codes, samples = pd.factorize(pd.concat([rank_rows['Barcode'].astype(object), inactive_pairs['Barcode'].astype(object)], ignore_index=True))
+    candidate_codes, candidates = pd.factorize(rank_rows['symbol'].astype(object), sort=True)
+    inactive_codes, inactive_genes = pd.factorize(inactive_pairs['symbol'], sort=True)
+    value_samples = sample_codes[:len(rank_rows)]
+    inactive_mask = np.zeros((len(samples), len(inactive_genes)))
+    inactive_mask[sample_codes[len(rank_rows):], inactive_codes] = 1
+
+    order = np.argsort(candidate_codes, kind='stable')
+    block_starts = np.searchsorted(candidate_codes[order], np.arange(0, len(candidates) + candidate_block, candidate_block))
+    blocks = []
+    for b, start in enumerate(range(0, len(candidates), candidate_block)):
+        rows = order[block_starts[b]:block_starts[b + 1]]
+        width = min(candidate_block, len(candidates) - start)
+        #a (sample, candidate) with several rows joins every inactive pair several times
+        row_counts = np.zeros((len(samples), width))
+        rank_sums = np.zeros((len(samples), width))
+        np.add.at(row_counts, (value_samples[rows], candidate_codes[rows] - start), 1)
+        np.add.at(rank_sums, (value_samples[rows], candidate_codes[rows] - start), ranks[rows])
+
+        n_1 = inactive_mask.T @ row_counts
+        sumx_1 = inactive_mask.T @ rank_sums
+        n_t = np.broadcast_to(row_counts.sum(axis=0), n_1.shape)
+        genes, cols = np.nonzero((n_t > min_sample_size) & (n_1 > min_inactive))
+        blocks.append((genes, cols + start, n_1[genes, cols], n_t[genes, cols], sumx_1[genes, cols]))
+
+    genes, cols, n_1, n_t, sumx_1 = [np.concatenate([block[i] for block in blocks]) if len(blocks) > 0 else np.zeros(0, dtype=int)
+                                     for i in range(5)]
+    U1 = sumx_1 - n_1 * (n_1 + 1) / 2.0
+    n1n2 = n_1 * (n_t - n_1)
+    den = np.sqrt(n_1 * (n_t - n_1) * (n_t + 1) / 12.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscore = direction * (U1 - n1n2 / 2.0) / den
+    results = pd.DataFrame({'symbol1': np.asarray(inactive_genes, dtype=object)[genes],
+                            'symbol2': np.asarray(candidates, dtype=object)[cols],
+                            'n1': n_1.astype(int),
+                            'n': n_t.astype(int),
+                            'U1': U1,
+                            'pvalue': STATS_operations.jstat_normal_cdf(zscore, 0.0, 1.0)})
+    results = results.loc[den > 0]
+    results = results.sort_values('pvalue', kind='mergesort')
+    return(results.reset_index(drop=True))
+
+
+def InactivePairs(expression_rows, cn_rows, mutation_pairs, SL_or_SDL, percentile_threshold, cn_threshold):
+    '''
+    Distinct (symbol, Barcode) pairs where an input gene is inactive (SL) or
+    overactive (SDL): expression PERCENT_RANK and copy number both below
+    (above) the thresholds, or one of the selected mutations
+    '''
+    counts = expression_rows.groupby('symbol')['data'].transform('count').values
+    min_ranks = expression_rows.groupby('symbol')['data'].rank(method='min').values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentile = np.where(counts > 1, (min_ranks - 1) / (counts - 1), 0.0)
+    if SL_or_SDL == 'SL':
+        expression_hits = expression_rows.loc[percentile < percentile_threshold / 100]
+        cn_hits = cn_rows.loc[cn_rows['data'] < cn_threshold]
+    else:
+        expression_hits = expression_rows.loc[percentile > percentile_threshold / 100]
+        cn_hits = cn_rows.loc[cn_rows['data'] > cn_threshold]
+    pairs = pd.merge(expression_hits[['symbol', 'Barcode']].astype(object).drop_duplicates(),
+                     cn_hits[['symbol', 'Barcode']].astype(object).drop_duplicates(), on=['symbol', 'Barcode'])
+    if mutation_pairs is not None:
+        pairs = pd.concat([pairs, mutation_pairs[['symbol', 'Barcode']]], ignore_index=True)
+    return(pairs.drop_duplicates().reset_index(drop=True))
+
+
+def InactiveSamples(client, SL_or_SDL, input_genes, samples, percentile_threshold, cn_threshold, input_mutations,
+                    gene_exp_table, gene_col_name, gene_exp, cn_rows, sample_id,
+                    mutation_table, mutation_gene_name, mutation_sample_id, mutation_filter=''):
+    '''
+    Fetches the expression rows and mutations of the input genes and returns
+    their InactivePairs, cn_rows being the copy number rows of the input genes
+    '''
+    expression_rows = FetchRows(client, input_values_sql, [('__TABLE_NAME__', gene_exp_table), ('__GENE_SYMBOL__', gene_col_name),
+                                                           ('__VALUE__', gene_exp), ('__SAMPLE_ID__', sample_id)],
+                                samples=samples, input_genes=input_genes)
+    mutation_pairs = None
+    if SL_or_SDL == 'SL' and input_mutations is not None:
+        mutation_pairs = FetchRows(client, mutations_sql, [('__TABLE_NAME__', mutation_table), ('__GENE_SYMBOL__', mutation_gene_name),
+                                                           ('__SAMPLE_ID__', mutation_sample_id), ('__FILTER__', mutation_filter)],
+                                   samples=samples, input_genes=input_genes, mutations=input_mutations)
+    return(InactivePairs(expression_rows, cn_rows, mutation_pairs, SL_or_SDL, percentile_threshold, cn_threshold))
+
+
+def SurvivalOfFittestResults(client, SL_or_SDL, input_genes, selected_samples, percentile_threshold, cn_threshold, input_mutations,
+                             gene_exp_table, gene_col_name, gene_exp, cn_table, cn_gene_name, cn_gistic, sample_id,
+                             mutation_table, mutation_gene_name, mutation_sample_id, mutation_filter=''):
+    '''
+    Local engine of SurvivalOfFittest, returns the columns of the SoF query
+    (symbol1, symbol2, n1, n, U1, pvalue) sorted by pvalue. The copy number
+    ranks come from the materialized RankTable.
+    '''
+    rank_rows = RankTable(client, values_sql, [('__TABLE_NAME__', cn_table), ('__GENE_SYMBOL__', cn_gene_name),
+                                               ('__VALUE__', cn_gistic), ('__SAMPLE_ID__', sample_id)],
+                          cn_table, selected_samples)
+    cn_rows = rank_rows.loc[rank_rows['symbol'].isin([str(x) for x in input_genes])]
+    inactive_pairs = InactiveSamples(client, SL_or_SDL, input_genes, selected_samples, percentile_threshold, cn_threshold, input_mutations,
+                                     gene_exp_table, gene_col_name, gene_exp, cn_rows, sample_id,
+                                     mutation_table, mutation_gene_name, mutation_sample_id, mutation_filter)
+    return(MannWhitneyResults(inactive_pairs, rank_rows, -1))
+
+
+def FunctionalExaminationResults(client, SL_or_SDL, input_genes, ccle_samples, percentile_threshold, cn_threshold, input_mutations,
+                                 dep_score_table, symbol, effect, sample_id, sample_info_table, rel_sample_id,
+                                 gene_exp_table, gene_exp, cn_table, mutation_table, ccle_sample_id):
+    '''
+    Local engine of FunctionalExamination, returns the columns of the query
+    (symbol1, symbol2, n1, n, U1, pvalue) sorted by pvalue. The dependency
+    scores, matched to DepMap_IDs through the sample info table, are ranked
+    once per cohort by RankTable.
+    '''
+    rank_rows = RankTable(client, effect_sql, [('__TABLE_NAME__', dep_score_table), ('__GENE_SYMBOL__', symbol),
+                                               ('__VALUE__', effect), ('__SAMPLE_ID__', sample_id),
+                                               ('__SAMPLE_INFO_TABLE__', sample_info_table), ('__REL_SAMPLE_ID__', rel_sample_id)],
+                          dep_score_table, ccle_samples)
+    cn_rows = FetchRows(client, input_values_sql, [('__TABLE_NAME__', cn_table), ('__GENE_SYMBOL__', symbol),
+                                                   ('__VALUE__', 'CNA'), ('__SAMPLE_ID__', ccle_sample_id)],
+                        samples=ccle_samples, input_genes=input_genes)
+    inactive_pairs = InactiveSamples(client, SL_or_SDL, input_genes, ccle_samples, percentile_threshold, cn_threshold, input_mutations,
+                                     gene_exp_table, symbol, gene_exp, cn_rows, ccle_sample_id,
+                                     mutation_table, symbol, ccle_sample_id)
+    return(MannWhitneyResults(inactive_pairs, rank_rows, 1))
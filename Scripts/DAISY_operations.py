@@ -6,40 +6,125 @@ from scipy import stats
 from google.cloud import bigquery
 import helper
 from helper import *
+import DAISY_local
+import QUERY_operations
+import INDEX_operations
+import STATS_operations
+
+# dtype plan of the procedure results: the gene symbols of the candidate pairs
+# are fetched as categories, the statistics keep their float64 precision
+result_dtypes = {'symbol1': 'category', 'symbol2': 'category'}
+
+# sharding of the input genes of the sql engines: a shard joins its genes with
+# about genome_genes genes in every sample, join_rows bounds the rows of one
+# shard query, shards run max_concurrent at a time and are resized towards
+# target_seconds each
+shard_settings = {
+    'join_rows': 4e9,
+    'genome_genes': 20000,
+    'max_concurrent': 4,
+    'target_seconds': 120
+}
+
+
+def ShardSize(n_samples):
+    '''
+    Input genes per shard for a cohort of n_samples samples
+    '''
+    return(max(1, int(shard_settings['join_rows'] / (max(n_samples, 1) * shard_settings['genome_genes']))))
+
+
+# Benjamini-Hochberg significance filter appended to a procedure query: keeps
+# the pairs ranked up to the last one with pvalue <= rank * threshold / tests
+# in their group (the input gene, or all pairs), which are the pairs whose
+# FDR can be below the threshold, with the number of tests of their group
+fdr_pushdown_sql = '''
+,
+tests AS (
+SELECT *,
+   ROW_NUMBER() OVER (__FDR_PARTITION__ ORDER BY pvalue) AS test_rank,
+   COUNT(*) OVER (__FDR_PARTITION__) AS group_tests
+FROM results
+WHERE __NOT_NULL__
+),
+cutoffs AS (
+SELECT *,
+   MAX(CASE WHEN pvalue <= test_rank * __FDR_BOUND__ / group_tests THEN test_rank ELSE 0 END) OVER (__FDR_PARTITION__) AS passing
+FROM tests
+)
+SELECT __COLUMNS__, group_tests
+FROM cutoffs
+WHERE test_rank <= passing
+'''
+
+
+def FDRPushdown(fdr_threshold, adj_method, fdr_level, input_genes, gene_mapping, shard_size):
+    '''
+    Whether the query can return only the pairs whose FDR can be below
+    fdr_threshold: the correction has to be Benjamini-Hochberg, for gene_level
+    no two input genes may be mapped to the same gene and for analysis_level
+    all pairs have to be ranked by one query, so the input genes have to fit
+    in one shard.
+    The gene_level query counts the tests per symbol1 while the report groups
+    the pairs by gene_mapping[symbol1]. symbol1 is always an input gene found
+    in the database, a pair of two input genes is tested once with the
+    smaller symbol as symbol1 and is in the group of that gene in both, so the
+    groups are the same when the mapping is one to one on the input genes.
+    PushdownGroups checks this on the downloaded pairs.
+    '''
+    if fdr_threshold is None or adj_method.lower() not in STATS_operations.fdr_bh_methods:
+        return(False)
+    genes= list(dict.fromkeys(input_genes))
+    if fdr_level=="gene_level":
+        mapped= [gene_mapping[gene] for gene in genes if gene in gene_mapping]
+        return(len(set(mapped))==len(mapped))
+    return(len(genes)<=shard_size)
+
+
+def PushdownGroups(report):
+    '''
+    Whether every gene_level group of report (Inactive) holds the pairs of a
+    single query partition (InactiveDB, the symbol1 of the query)
+    '''
+    symbols= report.groupby('Inactive', observed=True)['InactiveDB'].nunique()
+    return(bool((symbols<=1).all()))
+
+
+def FDRPushdownQuery(sql, columns, float_columns, fdr_level, fdr_threshold):
+    '''
+    Turns the final SELECT of a procedure query into a results table filtered
+    by fdr_pushdown_sql, keeping its ORDER BY. Like the dropna of the report,
+    the tests leave out the pairs with a NULL column or a NaN float_columns
+    value (CORR of a constant gene is NaN).
+    '''
+    head, order= sql.rsplit('ORDER BY', 1)
+    start= head.rfind('\nSELECT ')
+    not_null= [column + ' IS NOT NULL' for column in columns] + ['NOT IS_NAN(' + column + ')' for column in float_columns]
+    pushdown= CompileQuery(fdr_pushdown_sql, [('__FDR_PARTITION__', 'PARTITION BY symbol1' if fdr_level=="gene_level" else ''),
+                                              ('__NOT_NULL__', ' AND '.join(not_null)),
+                                              ('__FDR_BOUND__', repr(float(fdr_threshold)*(1+1e-9))),
+                                              ('__COLUMNS__', ', '.join(columns))])
+    return(head[:start] + ',\nresults AS (' + head[start:] + ')' + pushdown + 'ORDER BY' + order)
 
 
 def ProcessGeneAlias (client, input_gene_list, database):
-    pancanceratlas_genes_query="""SELECT DISTINCT Gene_Symbol from `isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene`
-    UNION DISTINCT  
-    SELECT DISTINCT Symbol from  `isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp`
-    UNION DISTINCT
-    SELECT DISTINCT Hugo_Symbol from `isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample`  """
-    depmap_genes_query= """ SELECT DISTINCT Hugo_Symbol from  `syntheticlethality.DepMap_public_20Q3.CCLE_gene_cn`
-    UNION DISTINCT
-    SELECT DISTINCT Hugo_Symbol from `syntheticlethality.DepMap_public_20Q3.CCLE_gene_expression` 
-    UNION DISTINCT
-    SELECT DISTINCT Hugo_Symbol from `syntheticlethality.DepMap_public_20Q3.CCLE_mutation`   """
+    '''
+    Maps the gene symbols of the database (PanCancerAtlas or DepMap) to the
+    input genes, an input gene missing from the database is matched through
+    its aliases. The gene universes of the databases are cached per release
+    by the gene index (INDEX_operations).
+    '''
     df=pd.DataFrame(columns=["Input_Gene", "DB_Gene"])
 
-    if database=="PanCancerAtlas":
-        pancancer_atlas_genes= list(client.query(pancanceratlas_genes_query).result().to_dataframe()['Gene_Symbol'])
-        df["Input_Gene" ]= input_gene_list
-        df.loc[df["Input_Gene" ].isin(pancancer_atlas_genes ),"DB_Gene"]=df.loc[df["Input_Gene" ].isin(pancancer_atlas_genes), "Input_Gene"]
-        search_genes= list(df.loc[~df["Input_Gene" ].isin(pancancer_atlas_genes ),"Input_Gene"])
-        if len(search_genes)>0:
-            converted=ConvertGene(client, search_genes, 'Gene', ['Alias'])  
-            add_lines= converted.loc[converted['Alias'].isin(pancancer_atlas_genes),]
-            add_lines.columns=["Input_Gene", "DB_Gene"]
-            df=pd.concat([df, add_lines])
-
-    elif database=="DepMap":
-        depmap_genes= list(client.query(depmap_genes_query).result().to_dataframe()['Hugo_Symbol'])
+    if database in ["PanCancerAtlas", "DepMap"]:
+        gene_index= INDEX_operations.GetGeneIndex(client)
         df["Input_Gene" ]= input_gene_list
-        df.loc[df["Input_Gene" ].isin(depmap_genes),"DB_Gene"]=df.loc[df["Input_Gene" ].isin(depmap_genes), "Input_Gene"]
-        search_genes= list(df.loc[~df["Input_Gene" ].isin(depmap_genes),"Input_Gene"])
+        in_database= gene_index.in_universe(client, database, df["Input_Gene"])
+        df.loc[in_database,"DB_Gene"]=df.loc[in_database, "Input_Gene"]
+        search_genes= list(df.loc[~in_database,"Input_Gene"])
         if len(search_genes)>0:
-            converted=ConvertGene(client, search_genes, 'Gene', ['Alias'])  
-            add_lines= converted.loc[converted['Alias'].isin(depmap_genes),]
+            converted=ConvertGene(client, search_genes, 'Gene', ['Alias'])
+            add_lines= converted.loc[gene_index.in_universe(client, database, converted['Alias']),]
             add_lines.columns=["Input_Gene", "DB_Gene"]
             df=pd.concat([df, add_lines])
     else:
@@ -58,135 +143,57 @@ def GetTCGASubtypes(client):
     return(list(all_tissues['TCGA_subtype']))
 
 def RetrieveSamples(client, data_resource, method, tissues):
-    min_sample_size=20;
-    input_tissues= ["'"+ str(x) + "'" for x in tissues]
-    input_tissues= ','.join(input_tissues)
-
-    if data_resource=='PanCancerAtlas' and method=='correlation':
-        tissue_query= " AND Study in (__TISSUE__)"
-        sample_selection_sql='''SELECT distinct SampleBarcode FROM `isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp` 
-    WHERE SampleType not like '%Normal%' and Study is not null '''
-        if tissues.count('pancancer')==0:          
-            sample_selection_sql=sample_selection_sql + tissue_query
-            sample_selection_sql= sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['SampleBarcode'])
-
-    elif data_resource=='PanCancerAtlas' and method=='sof':
-        tissue_query= " WHERE  TS.Study  in (__TISSUE__)"
-        sample_selection_sql= '''SELECT distinct SampleBarcode, Study FROM 
-                (SELECT distinct SampleBarcode, Study FROM `isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp`
-		WHERE SampleType not like '%Normal%'and Study is not null
-		INTERSECT DISTINCT
-		SELECT distinct SampleBarcode,  Study  FROM `isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene`
-		WHERE SampleType not like '%Normal%' and Study is not null
-		INTERSECT DISTINCT
-		SELECT distinct Tumor_SampleBarcode as  SampleBarcode,  Study  FROM `isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample` WHERE Study is not null)
-		TS '''
-
-        if tissues.count('pancancer')==0:
-            sample_selection_sql=sample_selection_sql + tissue_query
-            sample_selection_sql= sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['SampleBarcode'])
-
- 
-    elif data_resource=='CCLE' and method=='correlation':
-        tissue_query= " AND ST.TCGA_subtype in (__TISSUE__) "
-        sample_selection_sql= ''' SELECT  distinct ST.DepMap_ID FROM  `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-        `syntheticlethality.DepMap_public_20Q3.CCLE_gene_expression` E  
-         WHERE ST.primary_disease 
-        not in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND E.DepMap_ID=ST.DepMap_ID '''
-        if tissues.count('pancancer')==0:
-            sample_selection_sql=sample_selection_sql + tissue_query
-            sample_selection_sql=sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['DepMap_ID'])
+    '''
+    Samples of the tissues having the data a method needs, selected from the
+    in memory sample indexes (INDEX_operations) instead of intersecting joins
+    of the data tables
+    '''
+    if data_resource=='PanCancerAtlas':
+        sample_index= INDEX_operations.GetTumorSampleIndex(client)
+        if method=='correlation':
+            selected_samples= list(sample_index.select(['SampleBarcode'], ['expression'], 'Study', tissues)['SampleBarcode'])
+        elif method=='sof':
+            selected_samples= list(sample_index.select(['SampleBarcode', 'Study'], ['expression', 'cn', 'mutation'], 'Study', tissues)['SampleBarcode'])
+        else:
+            print("The method for PanCancerAtlas can be either correlation or sof")
+            return()
+        return selected_samples
+
+    sample_index= INDEX_operations.GetCellLineIndex(client)
+    cancer_cell_lines= {'primary_disease': INDEX_operations.non_cancer_diseases}
+    if data_resource=='CCLE' and method=='correlation':
+        selected_samples= list(sample_index.select(['DepMap_ID'], ['expression'], 'TCGA_subtype', tissues, cancer_cell_lines)['DepMap_ID'])
 
     elif data_resource=='CCLE' and method=='sof':
-        tissue_query=  " WHERE TS.TCGA_subtype in (__TISSUE__) "
-        sample_selection_sql= '''SELECT distinct DepMap_ID, TCGA_subtype FROM
-                (SELECT  distinct ST.DepMap_ID  AS DepMap_ID, ST.TCGA_subtype as TCGA_subtype
-                FROM  `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-   		 `syntheticlethality.DepMap_public_20Q3.CCLE_gene_expression` E  WHERE  ST.primary_disease not
-  		in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND E.DepMap_ID=ST.DepMap_ID 
-  		INTERSECT DISTINCT
-   		SELECT  distinct ST.DepMap_ID  AS DepMap_ID, ST.TCGA_subtype as TCGA_subtype FROM `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-   		`syntheticlethality.DepMap_public_20Q3.CCLE_gene_cn`  C  WHERE  ST.primary_disease not
-  		in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND C.DepMap_ID=ST.DepMap_ID 
-  		INTERSECT DISTINCT
-  		SELECT  distinct ST.DepMap_ID  AS DepMap_ID, ST.TCGA_subtype as TCGA_subtype
-  		FROM  `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-  		`syntheticlethality.DepMap_public_20Q3.CCLE_mutation` M  WHERE  ST.primary_disease not
-  		in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND M.DepMap_ID=ST.DepMap_ID ) TS'''
-        if tissues.count('pancancer')==0:
-            sample_selection_sql=sample_selection_sql+ tissue_query
-            sample_selection_sql=sample_selection_sql.replace('__TISSUE__', input_tissues)
-
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['DepMap_ID'])
+        selected_samples= list(sample_index.select(['DepMap_ID', 'TCGA_subtype'], ['expression', 'cn', 'mutation'],
+                                                   'TCGA_subtype', tissues, cancer_cell_lines)['DepMap_ID'])
 
-        
     elif data_resource=='CRISPR' and method=='func_ex':
-        tissue_query=  " WHERE TS.TCGA_subtype in (__TISSUE__) "
-        sample_selection_sql= '''SELECT distinct DepMap_ID, TCGA_subtype FROM
-        (SELECT  distinct ST.DepMap_ID AS DepMap_ID , ST.TCGA_subtype AS TCGA_subtype FROM `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-       `syntheticlethality.DepMap_public_20Q3.CCLE_gene_expression` E  WHERE  ST.primary_disease not
-      in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND E.DepMap_ID=ST.DepMap_ID 
-      INTERSECT DISTINCT
-      SELECT distinct ST.DepMap_ID AS DepMap_ID , ST.TCGA_subtype AS TCGA_subtype  FROM  `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-      `syntheticlethality.DepMap_public_20Q3.CCLE_gene_cn`  C  WHERE  ST.primary_disease not
-      in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND C.DepMap_ID=ST.DepMap_ID 
-      INTERSECT DISTINCT
-      SELECT distinct ST.DepMap_ID AS DepMap_ID , ST.TCGA_subtype AS TCGA_subtype  FROM  `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-      `syntheticlethality.DepMap_public_20Q3.CCLE_mutation` M  WHERE ST.primary_disease not
-      in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND M.DepMap_ID=ST.DepMap_ID 
-      INTERSECT DISTINCT
-      SELECT distinct ST.DepMap_ID AS DepMap_ID , ST.TCGA_subtype AS TCGA_subtype  FROM  `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-      `syntheticlethality.DepMap_public_20Q3.Achilles_gene_effect` A  WHERE  ST.primary_disease not
-      in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND A.DepMap_ID=ST.DepMap_ID)  TS'''
-        if tissues.count('pancancer')==0:
-            sample_selection_sql=sample_selection_sql+ tissue_query
-            sample_selection_sql=sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= list(client.query(sample_selection_sql).result().to_dataframe()['DepMap_ID'])
-
+        selected_samples= list(sample_index.select(['DepMap_ID', 'TCGA_subtype'], ['expression', 'cn', 'mutation', 'crispr'],
+                                                   'TCGA_subtype', tissues, cancer_cell_lines)['DepMap_ID'])
 
     elif data_resource=='shRNA' and method=='func_ex':
-        tissue_query="WHERE TS.TCGA_subtype in (__TISSUE__)"
-        sample_selection_sql= '''SELECT CCLE_Name, DepMap_ID FROM
-      (SELECT distinct ST.CCLE_Name AS CCLE_Name, ST.DepMap_ID  AS DepMap_ID, ST.TCGA_subtype AS TCGA_subtype  FROM
-      `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-      `syntheticlethality.DEMETER2_v6.D2_combined_gene_dep_score`   DS  WHERE ST.primary_disease not
-        in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND DS.CCLE_ID=ST.CCLE_Name
-
-      INTERSECT DISTINCT
-
-      SELECT distinct  ST.CCLE_Name AS CCLE_Name, ST.DepMap_ID  AS DepMap_ID, ST.TCGA_subtype AS TCGA_subtype
-        FROM  `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-     `syntheticlethality.DepMap_public_20Q3.CCLE_gene_expression`   E  WHERE   ST.primary_disease not
-     in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND E.DepMap_ID=ST.DepMap_ID
-
-      INTERSECT DISTINCT
-
-       SELECT  distinct ST.CCLE_Name AS CCLE_Name, ST.DepMap_ID  AS DepMap_ID,   ST.TCGA_subtype AS TCGA_subtype FROM
-     `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-       `syntheticlethality.DepMap_public_20Q3.CCLE_gene_cn`  C  WHERE ST.primary_disease not
-      in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND C.DepMap_ID=ST.DepMap_ID 
-
-      INTERSECT DISTINCT
-      SELECT  distinct ST.CCLE_Name AS CCLE_Name, ST.DepMap_ID  AS DepMap_ID, ST.TCGA_subtype AS TCGA_subtype FROM
-     `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` ST,
-       `syntheticlethality.DepMap_public_20Q3.CCLE_mutation` M  WHERE  ST.primary_disease not
-       in ('Non-Cancerous','Unknown','Engineered','Immortalized') AND M.DepMap_ID=ST.DepMap_ID) TS '''
-
-        if tissues.count('pancancer')==0:
-            sample_selection_sql=sample_selection_sql+ tissue_query
-            sample_selection_sql=sample_selection_sql.replace('__TISSUE__', input_tissues)
-        selected_samples= client.query(sample_selection_sql).result().to_dataframe()
-
+        selected_samples= sample_index.select(['CCLE_Name', 'DepMap_ID', 'TCGA_subtype'], ['expression', 'cn', 'mutation', 'shRNA'],
+                                              'TCGA_subtype', tissues, cancer_cell_lines)[['CCLE_Name', 'DepMap_ID']]
+    else:
+        print("Unknown data resource and method combination: " + str(data_resource) + ", " + str(method))
+        return()
 
     return selected_samples
 
-def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_method, fdr_level, tissues):
+def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_method, fdr_level, tissues, engine='sql', shard_size=None,
+                         fdr_threshold=None):
 
     '''
     The gene correlation information is used to detect SL pairs.
+    With engine='local' the expression matrix is fetched once and the Spearman
+    correlations are computed locally (DAISY_local) instead of in the query.
+    With engine='sql' the input genes are queried in concurrent shards of
+    shard_size genes (ShardSize of the cohort by default), the FDR is
+    computed once all shards are merged.
+    With fdr_threshold only the pairs with FDR below it are returned. For
+    Benjamini-Hochberg the sql engine then downloads only the pairs that can
+    pass, with the test counts their FDR is computed from (FDRPushdown).
     '''
   
     if data_resource=='PanCancerAtlas':
@@ -216,6 +223,9 @@ def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_meth
     if len(selected_samples)< (min_sample_size+1):
         print("Sample size needs to be greater than " +  str(min_sample_size) + ", it is " + str(len(selected_samples)))
         return()
+    if engine not in ['sql', 'local']:
+        print("The engine can be either sql or local")
+        return()
     sql_correlation= """ CREATE TEMPORARY FUNCTION tscore_to_p(a FLOAT64, b FLOAT64, c FLOAT64)
      RETURNS FLOAT64
     LANGUAGE js AS
@@ -238,10 +248,10 @@ def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_meth
       AVG( __EXP_NAME__)  AS data,
       __SAMPLE_ID__ AS ParticipantBarcode
    FROM `__TABLE_NAME__`
-   WHERE  __GENE_SYMBOL__   IN (__GENE_LIST__) # labels
-         AND __EXP_NAME__ IS NOT NULL  AND __SAMPLE_ID__ in (__SAMPLE_LIST__)
+   WHERE  __GENE_SYMBOL__   IN UNNEST(@shard_genes) # labels
+         AND __EXP_NAME__ IS NOT NULL  AND __SAMPLE_ID__ in UNNEST(@samples)
    GROUP BY
-      ParticipantBarcode, symbol
+      __SAMPLE_ID__, __GENE_SYMBOL__
        )
     )
     ,
@@ -257,9 +267,9 @@ def CoexpressionAnalysis(client, SL_or_SDL, data_resource, input_genes, adj_meth
       __SAMPLE_ID__ AS ParticipantBarcode
    FROM `__TABLE_NAME__`
    WHERE  __GENE_SYMBOL__ IS NOT NULL  # labels
-         AND __EXP_NAME__ IS NOT NULL AND __SAMPLE_ID__ in (__SAMPLE_LIST__)
+         AND __EXP_NAME__ IS NOT NULL AND __SAMPLE_ID__ in UNNEST(@samples)
    GROUP BY
-      ParticipantBarcode, symbol
+      __SAMPLE_ID__, __GENE_SYMBOL__
        )
     )
 ,
@@ -276,7 +286,7 @@ INNER JOIN
    table2 AS n2
 ON
    n1.ParticipantBarcode = n2.ParticipantBarcode
-   AND n2.symbol  NOT IN (__GENE_LIST__)
+   AND n2.symbol  NOT IN UNNEST(@input_genes)
 
 GROUP BY
    symbol1, symbol2
@@ -290,9 +300,10 @@ SELECT
 FROM
    table1 AS n1
 INNER JOIN
-   table1 AS n2
+   table2 AS n2
 ON
    n1.ParticipantBarcode = n2.ParticipantBarcode
+   AND n2.symbol IN UNNEST(@input_genes)
    AND n1.symbol <  n2.symbol
 GROUP BY
    symbol1, symbol2
@@ -307,40 +318,52 @@ GROUP BY 1,2,3,4,5
 #HAVING pvalue <= __P_THRESHOLD__
 ORDER BY symbol1 ASC, correlation DESC """
 
-    input_genes = ["'"+ str(x) + "'" for x in input_genes]
-    input_genes_for_query= ','.join(input_genes)
-
-    included_samples=["'"+ str(x) + "'" for x in selected_samples]
-    included_samples= ','.join(included_samples)
-
-    sql_correlation = sql_correlation.replace('__GENE_LIST__', input_genes_for_query)
-    sql_correlation = sql_correlation.replace('__TABLE_NAME__', table_name)
-    sql_correlation = sql_correlation.replace('__GENE_SYMBOL__', gene_col_name)
-    sql_correlation = sql_correlation.replace('__EXP_NAME__', exp_name)
-    sql_correlation = sql_correlation.replace('__SAMPLE_ID__', sample_barcode)
-    sql_correlation = sql_correlation.replace('__SAMPLE_LIST__', included_samples)
-
-
-    results= client.query(sql_correlation).result().to_dataframe()
+    pushdown=False
+    if engine=='local':
+        results= DAISY_local.CoexpressionResults(client, table_name, gene_col_name, exp_name, sample_barcode,
+                                                 input_genes, selected_samples, min_sample_size)
+    else:
+        sql_correlation = CompileQuery(sql_correlation, [('__TABLE_NAME__', table_name),
+                                                         ('__GENE_SYMBOL__', gene_col_name),
+                                                         ('__EXP_NAME__', exp_name),
+                                                         ('__SAMPLE_ID__', sample_barcode)])
+        if shard_size is None:
+            shard_size=ShardSize(len(selected_samples))
+        pushdown=FDRPushdown(fdr_threshold, adj_method, fdr_level, input_genes, gene_mapping, shard_size)
+        if pushdown:
+            sql_correlation=FDRPushdownQuery(sql_correlation, ['symbol1', 'symbol2', 'n', 'correlation', 'pvalue'],
+                                             ['correlation', 'pvalue'], fdr_level, fdr_threshold)
+        shards= QUERY_operations.RunShards(client, sql_correlation, 'shard_genes', input_genes, shard_size,
+                                           {'input_genes': input_genes, 'samples': selected_samples}, result_dtypes,
+                                           shard_settings['max_concurrent'], shard_settings['target_seconds'])
+        results= QUERY_operations.MergeShards(shards, ['symbol1', 'correlation'], [True, False], result_dtypes)
     if results.shape[0]<1:
         print("Coexpression inference procedure applied on " + data_resource + " did not find candidate " + SL_or_SDL + " pairs.")
-        return(results)
+        #with fdr_threshold the empty report is built below, with the same
+        #columns whether the FDR filter was pushed down or not
+        if fdr_threshold is None:
+            return(results)
         
     report=results[['symbol1', 'symbol2', 'n', 'correlation', 'pvalue']]
     report=report.dropna()
     report.columns=['InactiveDB', 'SL_Candidate', '#Samples', 'Correlation', 'PValue']
     report['Inactive']= report['InactiveDB'].map(gene_mapping)
+    if pushdown and fdr_level=="gene_level" and not PushdownGroups(report):
+        raise ValueError("The pushed down FDR groups do not match the input genes of the report")
+    counts= results.loc[report.index, 'group_tests'] if pushdown else None
     if fdr_level=="gene_level":
-        inactive_genes=list(report["Inactive"].unique())
-        for i in range(len(inactive_genes)):
-           report.loc[report["Inactive"]==inactive_genes[i],'FDR']=multipletests(report.loc[report["Inactive"]==inactive_genes[i], 'PValue'], method= adj_method, is_sorted=False)[1]
+        report['FDR']=STATS_operations.grouped_multipletests(report['PValue'], report['Inactive'], adj_method, counts)
 
+    elif fdr_level=="analysis_level" and pushdown:
+       report['FDR']=STATS_operations.grouped_multipletests(report['PValue'], None, adj_method, counts)
     elif fdr_level=="analysis_level":
        FDR=multipletests(report['PValue'],  method= adj_method, is_sorted=False)[1]
        report['FDR']=FDR
     else:
       print("FDR level can be either gene_level or analysis_level")
       return()
+    if fdr_threshold is not None:
+        report=report.loc[report['FDR']<fdr_threshold]
  
     report['Tissue']=str(tissues)
     cols=['Inactive', 'InactiveDB', 'SL_Candidate', '#Samples', 'Correlation', 'PValue', 'FDR', 'Tissue']
@@ -349,12 +372,21 @@ ORDER BY symbol1 ASC, correlation DESC """
       report.columns= ['Overactive', 'OveractiveDB', 'SL_Candidate', '#Samples', 'Correlation', 'PValue', 'FDR', 'Tissue']
     return report
 
-def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues, input_mutations='None'):
+def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues, input_mutations='None', engine='sql', shard_size=None,
+                      fdr_threshold=None):
 
   ''' percentile_threshold, cn_threshold, pval_correction,
   Gene expression, Copy Number Alteration, Somatic Mutations are used to decide whether gene is inactive.
   The SL pair detection according to difference in gene effect/dependency score
   given one gene is inactive vs not-inactive
+  With engine='local' the copy number table is ranked once and the Mann-Whitney
+  tests of all pairs are computed locally (DAISY_local) instead of in the query.
+  With engine='sql' the input genes are queried in concurrent shards of
+  shard_size genes (ShardSize of the cohort by default), the FDR is computed
+  once all shards are merged.
+  With fdr_threshold only the pairs with FDR below it are returned. For
+  Benjamini-Hochberg the sql engine then downloads only the pairs that can
+  pass, with the test counts their FDR is computed from (FDRPushdown).
   '''
   if data_source=='PanCancerAtlas':
         gene_exp_table='isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp'
@@ -395,6 +427,9 @@ def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_th
   if len(selected_samples)< (min_sample_size+1):
         print("Sample size needs to be greater than " +  str(min_sample_size), " it is " + str(len(selected_samples)))
         return()
+  if engine not in ['sql', 'local']:
+        print("The engine can be either sql or local")
+        return()
 
   sql_without_mutation= '''
     WITH
@@ -403,7 +438,7 @@ def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_th
     (SELECT GE.__EXP_GENE_NAME__ AS symbol, GE.__SAMPLE_ID__ AS Barcode ,
     PERCENT_RANK () over (partition by __EXP_GENE_NAME__ order by __GENE_EXPRESSION__ asc) AS Percentile
     FROM  __GENE_EXP_TABLE__ GE
-    WHERE GE.__EXP_GENE_NAME__ in (__GENELIST__)  AND __SAMPLE_ID__ in (__SAMPLE_LIST__) AND GE.__GENE_EXPRESSION__ is not null
+    WHERE GE.__EXP_GENE_NAME__ in UNNEST(@input_genes)  AND __SAMPLE_ID__ in UNNEST(@samples) AND GE.__GENE_EXPRESSION__ is not null
     )
     AS NGE
     WHERE NGE.Percentile  __GENE_CMP_STR__
@@ -414,7 +449,7 @@ def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_th
     (SELECT CN.__CN_GENE_NAME__ AS symbol, CN.__SAMPLE_ID__ AS Barcode,
     CN.__CN_GISTIC__ AS NORM_CN
     FROM  __CN_TABLE__ CN
-    WHERE CN.__CN_GENE_NAME__ in (__GENELIST__)  AND __SAMPLE_ID__ in (__SAMPLE_LIST__)  and CN.__CN_GISTIC__ is not null
+    WHERE CN.__CN_GENE_NAME__ in UNNEST(@input_genes)  AND __SAMPLE_ID__ in UNNEST(@samples)  and CN.__CN_GISTIC__ is not null
     ) AS NC
     WHERE NC.NORM_CN __CN_CMP_STR__
     )'''
@@ -425,8 +460,8 @@ def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_th
         UNION DISTINCT
         SELECT M.__MUTATION_GENE_NAME__  AS symbol , M.__MUTATION_SAMPLE_ID__ AS Barcode
         FROM __MUTATION_TABLE__ M
-        WHERE __MUTATION_GENE_NAME__ IN (__GENELIST__) AND
-        M.Variant_Classification IN (__MUTATIONLIST__) AND __MUT_SAMPLE_ID__ in (__SAMPLE_LIST__)
+        WHERE __MUTATION_GENE_NAME__ IN UNNEST(@input_genes) AND
+        M.Variant_Classification IN UNNEST(@mutations) AND __MUT_SAMPLE_ID__ in UNNEST(@samples)
         )'''
 
   elif data_source=='PanCancerAtlas':
@@ -434,8 +469,8 @@ def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_th
          UNION DISTINCT
         SELECT M.__MUTATION_GENE_NAME__  AS symbol , M.__MUTATION_SAMPLE_ID__ AS Barcode
         FROM __MUTATION_TABLE__ M
-        WHERE __MUTATION_GENE_NAME__ IN (__GENELIST__) AND
-        M.Variant_Classification IN (__MUTATIONLIST__) AND __MUT_SAMPLE_ID__ in (__SAMPLE_LIST__) AND Filter="PASS"
+        WHERE __MUTATION_GENE_NAME__ IN UNNEST(@input_genes) AND
+        M.Variant_Classification IN UNNEST(@mutations) AND __MUT_SAMPLE_ID__ in UNNEST(@samples) AND Filter="PASS"
         )'''
 
   rest_of_the_query= '''
@@ -445,7 +480,7 @@ def SurvivalOfFittest(client, SL_or_SDL, data_source, input_genes, percentile_th
         (RANK() OVER (PARTITION BY __CN_GENE_NAME__ ORDER BY __CN_GISTIC__ ASC)) + (COUNT(*) OVER ( PARTITION BY __CN_GENE_NAME__, CAST(__CN_GISTIC__ as STRING)) - 1)/2.0  AS rnkdata
     FROM
        __CN_TABLE__
-       where __CN_GENE_NAME__ IS NOT NULL  AND  __SAMPLE_ID__ in (__SAMPLE_LIST__) AND __CN_GISTIC__ is not null 
+       where __CN_GENE_NAME__ IS NOT NULL  AND  __SAMPLE_ID__ in UNNEST(@samples) AND __CN_GISTIC__ is not null 
        ),
 summ_table AS (
 SELECT
@@ -488,38 +523,12 @@ GROUP BY 1,2,3,4,5,6
 #HAVING pvalue <= 0.01
 ORDER BY pvalue ASC '''
 
-  input_genes = ["'"+ str(x) + "'" for x in input_genes]
-  input_genes_query= ','.join(input_genes)
-
-  included_samples=["'"+ str(x) + "'" for x in selected_samples]
-  included_samples= ','.join(included_samples)
-
-
   if SL_or_SDL=='SDL' or input_mutations is None:
       sql_sof=sql_without_mutation +  ')' +' ' +  rest_of_the_query
+      lists={'samples': selected_samples}
   else:
-      mutations_intermediate_representation = ["'"+x+"'" for x in input_mutations]
-      input_mutations_for_query = ','.join(mutations_intermediate_representation)
       sql_sof=sql_without_mutation + ' '+ sql_mutation_part + ' ' +  rest_of_the_query
-      sql_sof = sql_sof.replace('__MUTATION_TABLE__', mutation_table)
-      sql_sof = sql_sof.replace('__MUTATION_SAMPLE_ID__', mutation_sample_id)
-      sql_sof = sql_sof.replace('__MUTATIONLIST__', input_mutations_for_query)
-
-  sql_sof = sql_sof.replace('__GENELIST__', input_genes_query)
- # sql_sof = sql_sof.replace('__CUTOFFPRC__', str(percentile_threshold/100))
- # sql_sof = sql_sof.replace('__CUTOFFSCNA__', str(cn_threshold))
-  sql_sof = sql_sof.replace('__CN_TABLE__', cn_table)
-  sql_sof = sql_sof.replace('__GENE_EXP_TABLE__', gene_exp_table)
-  sql_sof = sql_sof.replace('__SAMPLE_ID__', sample_id)
-  sql_sof = sql_sof.replace('__MUT_SAMPLE_ID__', mutation_sample_id)
-  sql_sof = sql_sof.replace('__ENTREZ_ID__', entrez_id)
-  sql_sof = sql_sof.replace('__CN_TABLE__', cn_table)
-  sql_sof = sql_sof.replace('__GENE_EXPRESSION__', gene_exp)
-  sql_sof = sql_sof.replace('__CN_GISTIC__', cn_gistic)
-  sql_sof = sql_sof.replace('__EXP_GENE_NAME__', gene_col_name)
-  sql_sof = sql_sof.replace('__CN_GENE_NAME__', cn_gene_name)
-  sql_sof = sql_sof.replace('__MUTATION_GENE_NAME__', mutation_gene_name)
-  sql_sof= sql_sof.replace('__SAMPLE_LIST__', included_samples)
+      lists={'samples': selected_samples, 'mutations': input_mutations}
 
   if SL_or_SDL=="SL":
       comp_str="<"+str(cn_threshold)
@@ -527,35 +536,65 @@ ORDER BY pvalue ASC '''
 
   elif SL_or_SDL=="SDL":
       comp_str=">"+str(cn_threshold)
-      sql_sof= sql_sof.replace('__CN_CMP_STR__', comp_str)
       com_gene_th=">"+str(percentile_threshold/100)
-      sql_sof= sql_sof.replace('__GENE_CMP_STR__', com_gene_th)
-
-  sql_sof= sql_sof.replace('__CN_CMP_STR__', comp_str)
-  sql_sof= sql_sof.replace('__GENE_CMP_STR__', com_gene_th)
 
-
-  results= client.query(sql_sof).result().to_dataframe()
+  sql_sof = CompileQuery(sql_sof, [('__MUTATION_TABLE__', mutation_table),
+                                   ('__MUTATION_SAMPLE_ID__', mutation_sample_id),
+                                   ('__CN_TABLE__', cn_table),
+                                   ('__GENE_EXP_TABLE__', gene_exp_table),
+                                   ('__SAMPLE_ID__', sample_id),
+                                   ('__MUT_SAMPLE_ID__', mutation_sample_id),
+                                   ('__ENTREZ_ID__', entrez_id),
+                                   ('__GENE_EXPRESSION__', gene_exp),
+                                   ('__CN_GISTIC__', cn_gistic),
+                                   ('__EXP_GENE_NAME__', gene_col_name),
+                                   ('__CN_GENE_NAME__', cn_gene_name),
+                                   ('__MUTATION_GENE_NAME__', mutation_gene_name),
+                                   ('__CN_CMP_STR__', comp_str),
+                                   ('__GENE_CMP_STR__', com_gene_th)])
+
+  pushdown=False
+  if engine=='local':
+      results= DAISY_local.SurvivalOfFittestResults(client, SL_or_SDL, input_genes, selected_samples, percentile_threshold, cn_threshold,
+                                                    input_mutations, gene_exp_table, gene_col_name, gene_exp, cn_table, cn_gene_name,
+                                                    cn_gistic, sample_id, mutation_table, mutation_gene_name, mutation_sample_id,
+                                                    'AND Filter="PASS"' if data_source=='PanCancerAtlas' else '')
+  else:
+      if shard_size is None:
+          shard_size=ShardSize(len(selected_samples))
+      pushdown=FDRPushdown(fdr_threshold, adj_method, fdr_level, input_genes, gene_mapping, shard_size)
+      if pushdown:
+          sql_sof=FDRPushdownQuery(sql_sof, ['symbol1', 'symbol2', 'n1', 'n', 'U1', 'pvalue'],
+                                   ['U1', 'pvalue'], fdr_level, fdr_threshold)
+      shards= QUERY_operations.RunShards(client, sql_sof, 'input_genes', input_genes, shard_size, lists, result_dtypes,
+                                         shard_settings['max_concurrent'], shard_settings['target_seconds'])
+      results= QUERY_operations.MergeShards(shards, ['pvalue'], True, result_dtypes)
 
   if results.shape[0]<1:
-      print("SOF inference procedure applied on " + data_resource + " did not find candidate " + SL_or_SDL + " pairs.")
-      return(results)
+      print("SOF inference procedure applied on " + data_source + " did not find candidate " + SL_or_SDL + " pairs.")
+      if fdr_threshold is None:
+          return(results)
   report=results [['symbol1', 'symbol2', 'n1', 'n', 'U1', 'pvalue']]
   report=report.dropna()
   report.columns=['InactiveDB', 'SL_Candidate', '#InactiveSamples', '#Samples', 'U1','PValue']
   report['Inactive']= report['InactiveDB'].map(gene_mapping)
+  if pushdown and fdr_level=="gene_level" and not PushdownGroups(report):
+      raise ValueError("The pushed down FDR groups do not match the input genes of the report")
 
+  counts= results.loc[report.index, 'group_tests'] if pushdown else None
   if fdr_level=="gene_level":
-      inactive_genes=list(report["Inactive"].unique())
-      for i in range(len(inactive_genes)):
-         report.loc[report["Inactive"]==inactive_genes[i],'FDR']=multipletests(report.loc[report["Inactive"]==inactive_genes[i], 'PValue'], method= adj_method, is_sorted=False)[1]
+      report['FDR']=STATS_operations.grouped_multipletests(report['PValue'], report['Inactive'], adj_method, counts)
 
+  elif fdr_level=="analysis_level" and pushdown:
+     report['FDR']=STATS_operations.grouped_multipletests(report['PValue'], None, adj_method, counts)
   elif fdr_level=="analysis_level":
      FDR=multipletests(report['PValue'],  method= adj_method, is_sorted=False)[1]
      report['FDR']=FDR
   else:
     print("FDR level can be either gene_level or analysis_level")
     return()
+  if fdr_threshold is not None:
+      report=report.loc[report['FDR']<fdr_threshold]
  
   report['Tissue']=str(tissues)
   
@@ -566,13 +605,15 @@ ORDER BY pvalue ASC '''
   return report
 
   
-def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues,  input_mutations=None):
+def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues,  input_mutations=None, engine='sql'):
 
     '''
     Gene expression, Copy Number Alteration, Somatic Mutations (optional) are used to decide whether gene is inactive.
 
     The SL pair detection according to difference in gene effect/dependency score
     given one gene is inactive vs not-inactive
+    With engine='local' the dependency scores are ranked once per sample set
+    and the Mann-Whitney tests are computed locally (DAISY_local).
     '''
 
 
@@ -616,6 +657,9 @@ def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_t
     if len(selected_samples)< (min_sample_size+1):
         print("Sample size needs to be greater than " +  str(min_sample_size) + ", it is " + str(len(selected_samples)))
         return()
+    if engine not in ['sql', 'local']:
+        print("The engine can be either sql or local")
+        return()
     sql_without_mutation= """
     WITH
     table1 AS (
@@ -623,7 +667,7 @@ def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_t
     (SELECT GE.__SYMBOL__ AS symbol, GE.__CCLE_SAMPLE_ID__ AS Barcode ,
     PERCENT_RANK () over (partition by __SYMBOL__ order by __GENE_EXPRESSION__ asc) AS Percentile
     FROM  __GENE_EXP_TABLE__ GE
-    WHERE GE.__SYMBOL__ in (__GENELIST__) AND __CCLE_SAMPLE_ID__ in (__SAMPLE_LIST_CCLE__) AND __GENE_EXPRESSION__ is not null ) AS NGE
+    WHERE GE.__SYMBOL__ in UNNEST(@input_genes) AND __CCLE_SAMPLE_ID__ in UNNEST(@ccle_samples) AND __GENE_EXPRESSION__ is not null ) AS NGE
     WHERE NGE.Percentile __GENE_CMP_STR__
 
     INTERSECT DISTINCT
@@ -632,7 +676,7 @@ def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_t
     (SELECT CN.__SYMBOL__ AS symbol, CN.__CCLE_SAMPLE_ID__ AS Barcode,
     CN.CNA AS NORM_CN
     FROM  __CN_TABLE__ CN
-    WHERE CN.__SYMBOL__ in (__GENELIST__) AND __CCLE_SAMPLE_ID__ in (__SAMPLE_LIST_CCLE__) and    CN.CNA is not null) AS NC
+    WHERE CN.__SYMBOL__ in UNNEST(@input_genes) AND __CCLE_SAMPLE_ID__ in UNNEST(@ccle_samples) and    CN.CNA is not null) AS NC
     WHERE NC.NORM_CN __CN_CMP_STR__  )"""
 
 
@@ -641,8 +685,8 @@ def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_t
     UNION DISTINCT
     SELECT M.__SYMBOL__  AS symbol , M.__CCLE_SAMPLE_ID__ AS Barcode
     FROM __MUTATION_TABLE__ M
-    WHERE __SYMBOL__ IN (__GENELIST__) AND
-    M.Variant_Classification IN (__MUTATIONLIST__) AND __CCLE_SAMPLE_ID__ in (__SAMPLE_LIST_CCLE__))"""
+    WHERE __SYMBOL__ IN UNNEST(@input_genes) AND
+    M.Variant_Classification IN UNNEST(@mutations) AND __CCLE_SAMPLE_ID__ in UNNEST(@ccle_samples))"""
 
 
     rest_of_the_query= """
@@ -652,7 +696,7 @@ def FunctionalExamination(client, SL_or_SDL, database, input_genes, percentile_t
         (RANK() OVER (PARTITION BY __SYMBOL__ ORDER BY __EFFECT__ ASC)) + (COUNT(*) OVER ( PARTITION BY __SYMBOL__, CAST(__EFFECT__ as STRING)) - 1)/2.0  AS rnkdata
     FROM
        __ACHILLES_TABLE__ A, __SAMPLE_INFO_TABLE__ S  
-       where __SYMBOL__ IS NOT NULL AND __EFFECT__ IS NOT NULL AND  S.__REL_SAMPLE_ID__=A.__SAMPLE_ID__ AND S.DepMap_ID in (__SAMPLE_LIST_CCLE__)
+       where __SYMBOL__ IS NOT NULL AND __EFFECT__ IS NOT NULL AND  S.__REL_SAMPLE_ID__=A.__SAMPLE_ID__ AND S.DepMap_ID in UNNEST(@ccle_samples)
        ),
 summ_table AS (
 SELECT
@@ -694,38 +738,12 @@ GROUP BY 1,2,3,4,5,6
 #HAVING pvalue <= 0.01
 ORDER BY pvalue ASC """
 
-    genes_intermediate_representation = ["'" +str(x)+"'"  for x in input_genes]
-    input_genes_query= ','.join(genes_intermediate_representation)
-    included_samples=["'"+ str(x) + "'" for x in selected_samples]
-    included_samples= ','.join(included_samples)
-    included_samples_ccle=["'"+ str(x) + "'" for x in ccle_samples]
-    included_samples_ccle= ','.join(included_samples_ccle)
-
-
     if SL_or_SDL=='SDL' or input_mutations is None:
         sql_func_ex=sql_without_mutation +  ')' +' ' +  rest_of_the_query
+        job_config=ListParameters(input_genes=input_genes, ccle_samples=ccle_samples)
     else:
-        mutations_intermediate_representation = ["'"+x+"'" for x in input_mutations]
-        input_mutations_for_query = ','.join(mutations_intermediate_representation)
         sql_func_ex=sql_without_mutation + ' '+ sql_mutation_part + ' ' +  rest_of_the_query
-        sql_func_ex = sql_func_ex.replace('__MUTATION_TABLE__', mutation_table)
-        sql_func_ex = sql_func_ex.replace('__MUTATIONLIST__', input_mutations_for_query)
-
-    sql_func_ex = sql_func_ex.replace('__GENELIST__', input_genes_query)
-    sql_func_ex = sql_func_ex.replace('__CUTOFFPRC__', str(percentile_threshold/100))
-    sql_func_ex = sql_func_ex.replace('__CUTOFFSCNA__', str(cn_threshold))
-    sql_func_ex = sql_func_ex.replace('__CN_TABLE__', cn_table)
-    sql_func_ex = sql_func_ex.replace('__GENE_EXP_TABLE__', gene_exp_table)
-    sql_func_ex = sql_func_ex.replace('__SAMPLE_ID__', sample_id)
-    sql_func_ex = sql_func_ex.replace('__SYMBOL__', symbol)
-    sql_func_ex = sql_func_ex.replace('__ACHILLES_TABLE__', dep_score_table)
-    sql_func_ex = sql_func_ex.replace('__GENE_EXPRESSION__', gene_exp)
-    sql_func_ex = sql_func_ex.replace('__EFFECT__', effect)
-    sql_func_ex= sql_func_ex.replace('__SAMPLE_LIST__', included_samples)
-    sql_func_ex= sql_func_ex.replace('__SAMPLE_LIST_CCLE__', included_samples_ccle)
-    sql_func_ex= sql_func_ex.replace('__SAMPLE_INFO_TABLE__', sample_info_table)
-    sql_func_ex = sql_func_ex.replace('__CCLE_SAMPLE_ID__', ccle_sample_id)
-    sql_func_ex = sql_func_ex.replace('__REL_SAMPLE_ID__', cid)
+        job_config=ListParameters(input_genes=input_genes, ccle_samples=ccle_samples, mutations=input_mutations)
 
     if SL_or_SDL=="SL":
       comp_str="<"+str(cn_threshold)
@@ -735,10 +753,28 @@ ORDER BY pvalue ASC """
       comp_str=">"+str(cn_threshold)
       com_gene_th=">"+str(percentile_threshold/100)
 
-    sql_func_ex= sql_func_ex.replace('__CN_CMP_STR__', comp_str)
-    sql_func_ex= sql_func_ex.replace('__GENE_CMP_STR__', com_gene_th)
-
-    results= client.query(sql_func_ex).result().to_dataframe()
+    sql_func_ex = CompileQuery(sql_func_ex, [('__MUTATION_TABLE__', mutation_table),
+                                             ('__CUTOFFPRC__', str(percentile_threshold/100)),
+                                             ('__CUTOFFSCNA__', str(cn_threshold)),
+                                             ('__CN_TABLE__', cn_table),
+                                             ('__GENE_EXP_TABLE__', gene_exp_table),
+                                             ('__SAMPLE_ID__', sample_id),
+                                             ('__SYMBOL__', symbol),
+                                             ('__ACHILLES_TABLE__', dep_score_table),
+                                             ('__GENE_EXPRESSION__', gene_exp),
+                                             ('__EFFECT__', effect),
+                                             ('__SAMPLE_INFO_TABLE__', sample_info_table),
+                                             ('__CCLE_SAMPLE_ID__', ccle_sample_id),
+                                             ('__REL_SAMPLE_ID__', cid),
+                                             ('__CN_CMP_STR__', comp_str),
+                                             ('__GENE_CMP_STR__', com_gene_th)])
+
+    if engine=='local':
+        results= DAISY_local.FunctionalExaminationResults(client, SL_or_SDL, input_genes, ccle_samples, percentile_threshold, cn_threshold,
+                                                          input_mutations, dep_score_table, symbol, effect, sample_id, sample_info_table,
+                                                          cid, gene_exp_table, gene_exp, cn_table, mutation_table, ccle_sample_id)
+    else:
+        results= QUERY_operations.FetchFrame(client.query(sql_func_ex, job_config=job_config), result_dtypes)
     if results.shape[0]<1:
       print("Functional examimation inference procedure applied on " + data_resource + " did not find candidate " + SL_or_SDL + " pairs.")
       return(results)
@@ -749,9 +785,7 @@ ORDER BY pvalue ASC """
     report['Inactive']= report['InactiveDB'].map(gene_mapping)
     
     if fdr_level=="gene_level":
-       inactive_genes=list(report["Inactive"].unique())
-       for i in range(len(inactive_genes)):
-          report.loc[report["Inactive"]==inactive_genes[i],'FDR']=multipletests(report.loc[report["Inactive"]==inactive_genes[i], 'PValue'], method= adj_method, is_sorted=False)[1]
+       report['FDR']=STATS_operations.grouped_multipletests(report['PValue'], report['Inactive'], adj_method)
 
     elif fdr_level=="analysis_level":
       FDR=multipletests(report['PValue'],  method= adj_method, is_sorted=False)[1]
@@ -767,9 +801,36 @@ ORDER BY pvalue ASC """
       report.columns= ['Overactive', 'OveractiveDB', 'SL_Candidate','#Overactive', '#Samples', 'PValue', 'FDR', 'Tissue']
     return report
 
+def PairCodes(results, key):
+    '''
+    Integer codes of the (key, SL_Candidate) pairs of every result frame,
+    built from gene codes shared by all frames so that the pair codes sort
+    like the symbol pairs. Returns the codes per frame and the sorted gene
+    symbols, or None when a frame has a missing or repeated pair, which only
+    the pairwise merges handle.
+    '''
+    genes= pd.concat([frame[column] for frame in results for column in [key, 'SL_Candidate']], ignore_index=True)
+    gene_codes, gene_names= pd.factorize(genes, sort=True)
+    if (gene_codes<0).any():
+        return(None)
+    n_genes= len(gene_names)
+    pair_codes=[]
+    start=0
+    for frame in results:
+        size= frame.shape[0]
+        codes= gene_codes[start:start+size].astype(np.int64)*n_genes + gene_codes[start+size:start+2*size]
+        start= start + 2*size
+        sorted_codes= np.sort(codes)
+        if (sorted_codes[1:]==sorted_codes[:-1]).any():
+            return(None)
+        pair_codes.append(codes)
+    return(pair_codes, gene_names)
+
 def UnionResults(results, SL_or_SDL, labels, tissues):
     '''
     This functions merges results from the same inference procedure applied on different datasets. 
+    The frames are outer joined on (Inactive/Overactive, SL_Candidate) in one
+    pass over shared integer pair codes, frames with repeated pairs are merged pairwise.
     '''
     inds=[]
     for i in range(len(results)):
@@ -783,28 +844,51 @@ def UnionResults(results, SL_or_SDL, labels, tissues):
     for i in range(len(results)):
         results[i].reset_index(inplace=True, drop=True)
         results[i].rename(columns = {labels[i]:labels[i]+ str(i)}, inplace = True)
-    
-    combined_results=results[0]
-    for i in range(1,len(results)):
-        if SL_or_SDL=="SL":
-            combined_results =pd.merge(combined_results, results[i], on = ['Inactive',  'SL_Candidate'], how = 'outer')
-        elif SL_or_SDL=="SDL":
-            combined_results =pd.merge(combined_results, results[i], on = ['Overactive',  'SL_Candidate'], how = 'outer')
-
-    rel_cols=combined_results.columns[np.array([x.startswith(labels[i]) for x in combined_results.columns])]
-    p_matrix=combined_results[rel_cols]
 
-    combined_results["Tissue"]=str(tissues)
     if SL_or_SDL=="SL":
-        inc_cols= ['Inactive', 'SL_Candidate'] +  list(rel_cols) +['Tissue']
+        key='Inactive'
     elif SL_or_SDL=="SDL":
-       inc_cols= ['Overactive', 'SL_Candidate'] +  list(rel_cols) + ['Tissue']
+        key='Overactive'
+    label_columns=[[x for x in frame.columns if x.startswith(labels[i])] for frame in results]
+    encoded=None
+    if len(results)>1 and len(set(sum(label_columns, [])))==len(sum(label_columns, [])):
+        encoded=PairCodes(results, key)
+
+    if encoded is None:
+        combined_results=results[0]
+        for i in range(1,len(results)):
+            combined_results =pd.merge(combined_results, results[i], on = [key,  'SL_Candidate'], how = 'outer')
+        rel_cols=combined_results.columns[np.array([x.startswith(labels[i]) for x in combined_results.columns])]
+    else:
+        pair_codes, gene_names= encoded
+        stacked= np.concatenate(pair_codes)
+        order= np.argsort(stacked, kind='stable')
+        sorted_codes= stacked[order]
+        first= np.ones(len(sorted_codes), dtype=bool)
+        first[1:]= sorted_codes[1:]!=sorted_codes[:-1]
+        all_codes= sorted_codes[first]
+        row_positions= np.empty(len(stacked), dtype=np.int64)
+        row_positions[order]= np.cumsum(first)-1
+        combined_results= pd.DataFrame({key: gene_names.take(all_codes//len(gene_names)),
+                                        'SL_Candidate': gene_names.take(all_codes%len(gene_names))})
+        start=0
+        for frame, columns in zip(results, label_columns):
+            positions= row_positions[start:start+frame.shape[0]]
+            start= start + frame.shape[0]
+            for column in columns:
+                combined_results[column]= frame[column].set_axis(positions).reindex(np.arange(len(all_codes))).values
+        rel_cols=sum(label_columns, [])
 
+    combined_results["Tissue"]=str(tissues)
+    inc_cols= [key, 'SL_Candidate'] +  list(rel_cols) +['Tissue']
     return(combined_results[inc_cols])
 
 def MergeResults(results, SL_or_SDL, tissues):
     '''
-    The results from SoF, Coexpression and Fuctional Screening analysis are merged.    '''
+    The results from SoF, Coexpression and Fuctional Screening analysis are merged.
+    The pairs found by every procedure are kept in the order of the first
+    frame, using shared integer pair codes unless a frame repeats a pair.
+    '''
     inds=[]
     for i in range(len(results)):
         if results[i].shape[0]<1:
@@ -813,25 +897,87 @@ def MergeResults(results, SL_or_SDL, tissues):
         print("At least one of the inference procedure did not return results")
         print("No SL pairs found by every pipeline")
         return()
-    indices = sorted(inds, reverse=True)
-    for idx in indices:
-        if idx < len(results):
-            results.pop(idx)
     for i in range(len(results)):
         results[i].reset_index(inplace=True, drop=True)
 
-    combined_results=results[0]
-    for i in range(1,len(results)):
-        if SL_or_SDL=="SL":
-            combined_results =pd.merge(combined_results, results[i], on = ['Inactive',  'SL_Candidate'], how = 'inner')
-        elif SL_or_SDL=="SDL":
-            combined_results =pd.merge(combined_results, results[i], on = ['Overactive',  'SL_Candidate'], how = 'inner')
-
-    combined_results["Tissue"]=str(tissues)
-
     if SL_or_SDL=="SL":
-        inc_cols= ['Inactive', 'SL_Candidate'] 
+        key='Inactive'
     elif SL_or_SDL=="SDL":
-        inc_cols= ['Overactive', 'SL_Candidate']
+        key='Overactive'
+    encoded=PairCodes(results, key)
+
+    if encoded is None:
+        combined_results=results[0]
+        for i in range(1,len(results)):
+            combined_results =pd.merge(combined_results, results[i], on = [key,  'SL_Candidate'], how = 'inner')
+    else:
+        pair_codes, gene_names= encoded
+        keep= np.ones(len(pair_codes[0]), dtype=bool)
+        for codes in pair_codes[1:]:
+            keep &= np.isin(pair_codes[0], codes, assume_unique=True)
+        combined_results=results[0].loc[keep, [key, 'SL_Candidate']].reset_index(drop=True)
+
+    combined_results["Tissue"]=str(tissues)
+    inc_cols= [key, 'SL_Candidate']
     return(combined_results[inc_cols])
 
+def FilterReport(report, label, p_column, p_threshold, cor_threshold=None):
+    '''
+    Keeps the pairs of a procedure report below p_threshold (and above
+    cor_threshold for coexpression) sorted by p_column within each gene, as in
+    the DAISY example notebook. Failed procedures give an empty frame.
+    '''
+    if not isinstance(report, pd.DataFrame) or report.shape[0]<1:
+        return(pd.DataFrame())
+    keep= report[p_column] < p_threshold
+    if cor_threshold is not None:
+        keep= keep & (report['Correlation'] > cor_threshold)
+    return(report.loc[keep].sort_values([label, p_column], kind='mergesort'))
+
+
+def run_daisy(client, SL_or_SDL, input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues, input_mutations=None,
+              p_threshold=0.05, cor_threshold=0.5, engine='sql', max_concurrent=4, retries=3, pushdown=False):
+    '''
+    Runs the six DAISY procedures (coexpression on PanCancerAtlas and CCLE,
+    SoF on CCLE and PanCancerAtlas, functional examination on CRISPR and
+    shRNA) concurrently through a QueryExecutor, so the wall time is bounded
+    by the slowest procedure. The filtered reports are combined with
+    UnionResults per procedure and MergeResults.
+    With pushdown the coexpression and SoF procedures get p_threshold as
+    fdr_threshold, so their reports only hold the pairs FilterReport keeps.
+    Returns a dictionary with the six reports and the coexpression, sof,
+    functional_examination and merged results.
+    '''
+    fdr_options= {'engine': engine, 'fdr_threshold': p_threshold if pushdown else None}
+    executor= QUERY_operations.QueryExecutor(client, max_concurrent, retries)
+    names= ['coexp_pancancer', 'coexp_CCLE', 'sof_CCLE', 'sof_pancancer', 'crispr', 'shRNA']
+    tasks= [(CoexpressionAnalysis, (SL_or_SDL, 'PanCancerAtlas', input_genes, adj_method, fdr_level, tissues), fdr_options),
+            (CoexpressionAnalysis, (SL_or_SDL, 'CCLE', input_genes, adj_method, fdr_level, tissues), fdr_options),
+            (SurvivalOfFittest, (SL_or_SDL, 'CCLE', input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues, input_mutations), fdr_options),
+            (SurvivalOfFittest, (SL_or_SDL, 'PanCancerAtlas', input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues, input_mutations), fdr_options),
+            (FunctionalExamination, (SL_or_SDL, 'CRISPR', input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues, input_mutations), {'engine': engine}),
+            (FunctionalExamination, (SL_or_SDL, 'shRNA', input_genes, percentile_threshold, cn_threshold, adj_method, fdr_level, tissues, input_mutations), {'engine': engine})]
+    try:
+        results= dict(zip(names, executor.run_tasks(tasks)))
+    finally:
+        executor.shutdown()
+
+    label= 'Inactive' if SL_or_SDL=="SL" else 'Overactive'
+    reports= {name: FilterReport(results[name], label, 'FDR', p_threshold, cor_threshold) for name in ['coexp_pancancer', 'coexp_CCLE']}
+    reports.update({name: FilterReport(results[name], label, 'FDR', p_threshold) for name in ['sof_CCLE', 'sof_pancancer']})
+    reports.update({name: FilterReport(results[name], label, 'PValue', p_threshold) for name in ['crispr', 'shRNA']})
+
+    unions= [('coexpression', ['coexp_pancancer', 'coexp_CCLE'], 'FDR'),
+             ('sof', ['sof_CCLE', 'sof_pancancer'], 'FDR'),
+             ('functional_examination', ['crispr', 'shRNA'], 'PValue')]
+    for union_name, parts, p_column in unions:
+        if all(reports[name].shape[0]<1 for name in parts):
+            print("No Result From " + union_name + " inference procedure")
+            results[union_name]= pd.DataFrame()
+            continue
+        union= UnionResults([reports[name] for name in parts], SL_or_SDL, [p_column, p_column], tissues)
+        results[union_name]= union.sort_values(label)
+
+    merged= MergeResults([results[name] for name, parts, p_column in unions], SL_or_SDL, tissues)
+    results['merged']= merged.sort_values(label) if isinstance(merged, pd.DataFrame) else pd.DataFrame()
+    return(results)
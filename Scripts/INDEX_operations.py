@@ -0,0 +1,381 @@
+import numpy as np
+import pandas as pd
+import CACHE_operations
+
+gene_info_release = 'gene_information'
+
+gene_info_query = '''
+    SELECT Gene, Alias, EntrezID
+    FROM `syntheticlethality.gene_information.gene_info_human`
+    '''
+
+# gene symbol universes of the data tables: name -> (release, query returning a symbol column)
+universe_queries = {
+    'CCLE_mutation': ('DepMap_public_20Q3', '''
+        SELECT DISTINCT Hugo_Symbol AS symbol
+        FROM `syntheticlethality.DepMap_public_20Q3.CCLE_mutation`
+        '''),
+    'DepMap': ('DepMap_public_20Q3', '''
+        SELECT DISTINCT Hugo_Symbol AS symbol FROM `syntheticlethality.DepMap_public_20Q3.CCLE_gene_cn`
+        UNION DISTINCT
+        SELECT DISTINCT Hugo_Symbol AS symbol FROM `syntheticlethality.DepMap_public_20Q3.CCLE_gene_expression`
+        UNION DISTINCT
+        SELECT DISTINCT Hugo_Symbol AS symbol FROM `syntheticlethality.DepMap_public_20Q3.CCLE_mutation`
+        '''),
+    'PanCancerAtlas': ('pancancer_atlas', '''
+        SELECT DISTINCT Gene_Symbol AS symbol FROM `isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene`
+        UNION DISTINCT
+        SELECT DISTINCT Symbol AS symbol FROM `isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp`
+        UNION DISTINCT
+        SELECT DISTINCT Hugo_Symbol AS symbol FROM `isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample`
+        ''')
+}
+
+# GeneIndex objects, keyed by the gene_info release
+gene_indexes = {}
+
+depmap_release = 'DepMap_public_20Q3'
+demeter_release = 'DEMETER2_v6'
+pancancer_release = 'pancancer_atlas'
+
+# primary diseases of the cell lines left out of every analysis
+non_cancer_diseases = ['Non-Cancerous', 'Unknown', 'Engineered', 'Immortalized']
+
+cell_line_query = '''
+    SELECT DepMap_ID, CCLE_Name, primary_disease, TCGA_subtype
+    FROM `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels`
+    '''
+
+# cell lines with data in each DepMap table, CCLE_gene_expression etc. are matched on DepMap_ID
+cell_line_availability_query = '''
+    SELECT DISTINCT DepMap_ID AS id, 'expression' AS modality FROM `syntheticlethality.DepMap_public_20Q3.CCLE_gene_expression`
+    UNION ALL
+    SELECT DISTINCT DepMap_ID AS id, 'cn' AS modality FROM `syntheticlethality.DepMap_public_20Q3.CCLE_gene_cn`
+    UNION ALL
+    SELECT DISTINCT DepMap_ID AS id, 'mutation' AS modality FROM `syntheticlethality.DepMap_public_20Q3.CCLE_mutation`
+    UNION ALL
+    SELECT DISTINCT DepMap_ID AS id, 'crispr' AS modality FROM `syntheticlethality.DepMap_public_20Q3.Achilles_gene_effect`
+    '''
+
+# DEMETER2 cell lines are matched on CCLE_Name
+shRNA_availability_query = '''
+    SELECT DISTINCT CCLE_ID AS id FROM `syntheticlethality.DEMETER2_v6.D2_combined_gene_dep_score`
+    '''
+
+# (sample, study) pairs with data in each PanCancer Atlas table, normal samples excluded
+tumor_sample_availability_query = '''
+    SELECT DISTINCT SampleBarcode, Study, 'expression' AS modality
+    FROM `isb-cgc-bq.pancancer_atlas.Filtered_EBpp_AdjustPANCAN_IlluminaHiSeq_RNASeqV2_genExp`
+    WHERE SampleType NOT LIKE '%Normal%' AND Study IS NOT NULL
+    UNION ALL
+    SELECT DISTINCT SampleBarcode, Study, 'cn' AS modality
+    FROM `isb-cgc-bq.pancancer_atlas.Filtered_all_CNVR_data_by_gene`
+    WHERE SampleType NOT LIKE '%Normal%' AND Study IS NOT NULL
+    UNION ALL
+    SELECT DISTINCT Tumor_SampleBarcode AS SampleBarcode, Study, 'mutation' AS modality
+    FROM `isb-cgc-bq.pancancer_atlas.Filtered_MC3_MAF_V5_one_per_tumor_sample`
+    WHERE Study IS NOT NULL
+    '''
+
+# SampleIndex objects, keyed by name
+sample_indexes = {}
+
+
+class GeneIndex:
+    '''
+    In memory index of gene_info_human: hash maps from every Gene, Alias and
+    EntrezID value to its rows, so identifier conversions are dictionary
+    lookups instead of table scans. Gene symbol universes of the data tables
+    (universe_queries) are loaded on first use.
+    '''
+
+    id_types = ['Gene', 'Alias', 'EntrezID']
+
+    def __init__(self, gene_info):
+        self.gene_info = gene_info.reset_index(drop=True)
+        self.values = {}
+        self.positions = {}
+        for id_type in self.id_types:
+            self.values[id_type] = np.asarray(self.gene_info[id_type], dtype=object)
+            groups = self.gene_info.groupby(id_type).indices
+            self.positions[id_type] = {str(value): rows for value, rows in groups.items()}
+        self.universes = {}
+        self.universe_arrays = {}
+
+    def rows(self, id_type, input_vector):
+        '''
+        Sorted gene_info rows whose id_type value is in input_vector
+        '''
+        positions = self.positions[id_type]
+        found = [positions[str(x)] for x in set(input_vector) if str(x) in positions]
+        if len(found) == 0:
+            return(np.zeros(0, dtype=int))
+        return(np.unique(np.concatenate(found)))
+
+    def convert(self, input_vector, input_type, output_type):
+        '''
+        Distinct (input_type, output_type...) rows for the input_vector values,
+        the same frame helper.ConvertGene returned from BigQuery
+        '''
+        columns = [self.gene_info.columns.get_loc(x) for x in [input_type] + list(output_type)]
+        result = self.gene_info.iloc[self.rows(input_type, input_vector), columns]
+        return(result.drop_duplicates().reset_index(drop=True))
+
+    def has_gene(self, gene):
+        return(str(gene) in self.positions['Gene'])
+
+    def aliases(self, gene):
+        '''
+        Aliases of an official gene symbol
+        '''
+        rows = self.positions['Gene'].get(str(gene), [])
+        return(set(self.values['Alias'][rows]))
+
+    def alias_to_gene(self, Gene_list):
+        '''
+        Maps every alias of the genes in Gene_list to its gene symbol
+        '''
+        rows = self.rows('Gene', Gene_list)
+        return(dict(zip(self.values['Alias'][rows], self.values['Gene'][rows])))
+
+    def universe_array(self, client, name):
+        '''
+        Sorted array of the gene symbols present in the data table name of
+        universe_queries. It is queried once per release and kept on disk.
+        '''
+        if name not in self.universe_arrays:
+            release, sql = universe_queries[name]
+            data = CACHE_operations.CachedQuery(client, 'universe_' + name, sql, release, persist=True)
+            self.universe_arrays[name] = np.sort(np.asarray(data['symbol'].dropna().unique(), dtype=object))
+        return(self.universe_arrays[name])
+
+    def universe(self, client, name):
+        '''
+        Set of gene symbols present in the data table name of universe_queries
+        '''
+        if name not in self.universes:
+            self.universes[name] = set(self.universe_array(client, name))
+        return(self.universes[name])
+
+    def in_universe(self, client, name, genes):
+        '''
+        Boolean array telling which genes are in the universe name
+        '''
+        return(pd.Series(np.asarray(genes, dtype=object)).isin(self.universe_array(client, name)).values)
+
+
+def GetGeneIndex(client, release=gene_info_release):
+    '''
+    Returns the GeneIndex of a gene_info release. It is built once per process
+    from a copy of gene_info_human kept in the local cache, so only the very
+    first call queries the table.
+    '''
+    if release not in gene_indexes:
+        gene_info = CACHE_operations.CachedQuery(client, 'gene_info_human', gene_info_query, release, persist=True)
+        gene_indexes[release] = GeneIndex(gene_info)
+    return(gene_indexes[release])
+
+
+def ClearGeneIndex(disk=False):
+    '''
+    Drops the in memory indexes, disk=True also removes the cached gene_info
+    and universe tables so they are queried again
+    '''
+    gene_indexes.clear()
+    CACHE_operations.ClearQueryCache(gene_info_release, disk, 'gene_info_human')
+    for name, (release, sql) in universe_queries.items():
+        CACHE_operations.ClearQueryCache(release, disk, 'universe_' + name)
+
+
+class MutationMatrix:
+    '''
+    Compact form of the CCLE_mutation records (Hugo_Symbol, DepMap_ID,
+    Variant_Classification). Genes, cell lines and variant classes become
+    sorted categorical indexes, the records integer codes sorted by gene, so
+    the records of a gene are one slice. For every mutated (gene, cell line)
+    pair a bitmask holds the variant classes it carries.
+    '''
+
+    def __init__(self, Mut_mat):
+        gene_codes, self.genes = pd.factorize(Mut_mat['Hugo_Symbol'], sort=True)
+        cell_codes, self.cell_lines = pd.factorize(Mut_mat['DepMap_ID'], sort=True)
+        variant_codes, self.variants = pd.factorize(Mut_mat['Variant_Classification'], sort=True)
+        if len(self.variants) > 64:
+            raise ValueError('MutationMatrix supports at most 64 variant classes')
+        keep = (gene_codes >= 0) & (cell_codes >= 0)
+        order = np.lexsort((cell_codes[keep], gene_codes[keep]))
+        gene_codes = gene_codes[keep][order]
+        self.cell_code = cell_codes[keep][order].astype(np.int32)
+        self.variant_code = variant_codes[keep][order].astype(np.int8)
+        self.gene_start = np.searchsorted(gene_codes, np.arange(len(self.genes) + 1))
+
+        #one entry per mutated (gene, cell line) pair, missing variant classes set no bit
+        bits = np.where(self.variant_code >= 0, np.left_shift(np.uint64(1), self.variant_code.astype(np.uint64)), np.uint64(0))
+        pair_first = np.flatnonzero(np.r_[True, (np.diff(gene_codes) != 0) | (np.diff(self.cell_code) != 0)]) \
+            if len(gene_codes) > 0 else np.zeros(0, dtype=int)
+        self.pair_cell = self.cell_code[pair_first]
+        self.pair_mask = np.bitwise_or.reduceat(bits, pair_first) if len(pair_first) > 0 else np.zeros(0, dtype=np.uint64)
+        self.pair_start = np.searchsorted(pair_first, self.gene_start)
+
+        self.gene_codes = dict(zip(self.genes, range(len(self.genes))))
+        self.cell_line_names = np.asarray(self.cell_lines, dtype=object)
+        self.bits_by_variants = {}
+
+    def variant_bits(self, variants=None):
+        '''
+        Bitmask of the variant classes in variants, all classes by default
+        '''
+        if variants is None:
+            return(np.uint64(2**len(self.variants) - 1))
+        variants = frozenset(variants)
+        if variants not in self.bits_by_variants:
+            codes = self.variants.get_indexer(list(variants))
+            self.bits_by_variants[variants] = np.uint64(sum(2**int(code) for code in codes if code >= 0))
+        return(self.bits_by_variants[variants])
+
+    def mutated_cell_lines(self, gene, variants=None):
+        '''
+        Cell lines with a mutation of one of the variant classes in gene
+        '''
+        code = self.gene_codes.get(gene)
+        if code is None:
+            return(np.zeros(0, dtype=object))
+        pairs = slice(self.pair_start[code], self.pair_start[code + 1])
+        mutated = (self.pair_mask[pairs] & self.variant_bits(variants)) != 0
+        return(self.cell_line_names[self.pair_cell[pairs][mutated]])
+
+    def record_counts(self, cell_lines, genes, variants=None):
+        '''
+        Cell line x gene matrix counting the records of the variant classes,
+        a cell line with two records of a gene counts twice
+        '''
+        gene_codes = self.genes.get_indexer(list(genes))
+        starts = np.where(gene_codes >= 0, self.gene_start[gene_codes], 0)
+        ends = np.where(gene_codes >= 0, self.gene_start[gene_codes + 1], 0)
+        lengths = ends - starts
+        #positions of all records of the genes and the column each belongs to
+        columns = np.repeat(np.arange(len(gene_codes)), lengths)
+        records = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+
+        variant_codes = np.arange(len(self.variants))
+        if variants is not None:
+            variant_codes = variant_codes[np.isin(variant_codes, self.variants.get_indexer(list(set(variants))))]
+        keep = np.isin(self.variant_code[records], variant_codes)
+        rows = pd.Index(cell_lines).get_indexer(self.cell_line_names)[self.cell_code[records[keep]]]
+        counts = np.zeros((len(cell_lines), len(gene_codes)))
+        np.add.at(counts, (rows[rows >= 0], columns[keep][rows >= 0]), 1)
+        return(pd.DataFrame(counts, index=cell_lines, columns=genes))
+
+    def mutation_mask(self, cell_lines, genes, variants=None):
+        '''
+        Cell line x gene boolean matrix of the mutated pairs
+        '''
+        return(self.record_counts(cell_lines, genes, variants) > 0)
+
+    def nbytes(self):
+        return(sum(x.nbytes for x in [self.cell_code, self.variant_code, self.gene_start,
+                                      self.pair_cell, self.pair_mask, self.pair_start]))
+
+
+class SampleIndex:
+    '''
+    In memory table of the samples of a data release: the identity columns
+    as arrays and, per sample, a bitmask of the modalities (modalities
+    attribute) it has data for. Selecting the samples of any tissue and
+    modality combination is a mask operation instead of joins of the long
+    data tables.
+    '''
+
+    modalities = ['expression', 'cn', 'mutation', 'crispr', 'shRNA']
+
+    def __init__(self, samples, available):
+        '''
+        available holds (modality, ids) pairs, ids being a frame of identity
+        columns of the samples with data of the modality
+        '''
+        self.samples = samples.reset_index(drop=True)
+        self.values = {column: np.asarray(self.samples[column], dtype=object) for column in self.samples.columns}
+        self.mask = np.zeros(len(self.samples), dtype=np.uint8)
+        for modality, ids in available:
+            keys = pd.MultiIndex.from_frame(self.samples[list(ids.columns)])
+            has = keys.isin(pd.MultiIndex.from_frame(ids.dropna().drop_duplicates()))
+            self.mask |= np.where(has, self.modality_bits([modality]), 0).astype(np.uint8)
+        self.name_map = None
+
+    def modality_bits(self, modalities):
+        return(np.uint8(sum(2**self.modalities.index(x) for x in modalities)))
+
+    def rows(self, modalities=(), tissue_column=None, tissues=None, exclude=None):
+        '''
+        Boolean mask of the samples with data of all modalities, whose
+        tissue_column is in tissues (all tissues for None or 'pancancer') and
+        whose columns have none of the exclude values (column -> values).
+        Missing tissue or exclude values never match, as in SQL.
+        '''
+        bits = self.modality_bits(modalities)
+        keep = (self.mask & bits) == bits
+        if tissues is not None and list(tissues).count('pancancer') == 0:
+            keep &= pd.Series(self.values[tissue_column]).isin(list(tissues)).values
+        for column, values in (exclude or {}).items():
+            keep &= pd.notna(self.values[column]) & ~pd.Series(self.values[column]).isin(list(values)).values
+        return(keep)
+
+    def select(self, columns, modalities=(), tissue_column=None, tissues=None, exclude=None):
+        '''
+        Distinct columns of the samples of rows(...)
+        '''
+        keep = self.rows(modalities, tissue_column, tissues, exclude)
+        return(self.samples.loc[keep, list(columns)].drop_duplicates().reset_index(drop=True))
+
+    def depmap_ids(self, ccle_names):
+        '''
+        DepMap_IDs of CCLE names, NaN for unknown names. A name listed twice
+        maps to its last DepMap_ID.
+        '''
+        if self.name_map is None:
+            names = self.samples.drop_duplicates('CCLE_Name', keep='last')
+            self.name_map = pd.Series(names['DepMap_ID'].values, index=names['CCLE_Name'].values)
+        return(self.name_map.reindex(list(ccle_names)).values)
+
+
+def GetCellLineIndex(client):
+    '''
+    SampleIndex of the DepMap cell lines (DepMap_ID, CCLE_Name,
+    primary_disease, TCGA_subtype) with their expression, cn, mutation,
+    crispr and shRNA availability. Its tables are persisted per release, so
+    it is built without table scans after the first session.
+    '''
+    if 'cell_lines' not in sample_indexes:
+        cell_lines = CACHE_operations.CachedQuery(client, 'cell_line_info', cell_line_query, depmap_release, persist=True)
+        availability = CACHE_operations.CachedQuery(client, 'cell_line_availability', cell_line_availability_query, depmap_release, persist=True)
+        shRNA = CACHE_operations.CachedQuery(client, 'shRNA_cell_lines', shRNA_availability_query, demeter_release, persist=True)
+        available = [(modality, availability.loc[availability['modality'] == modality, ['id']].rename(columns={'id': 'DepMap_ID'}))
+                     for modality in ['expression', 'cn', 'mutation', 'crispr']]
+        available.append(('shRNA', shRNA.rename(columns={'id': 'CCLE_Name'})))
+        sample_indexes['cell_lines'] = SampleIndex(cell_lines, available)
+    return(sample_indexes['cell_lines'])
+
+
+def GetTumorSampleIndex(client):
+    '''
+    SampleIndex of the PanCancer Atlas tumor samples (SampleBarcode, Study)
+    with their expression, cn and mutation availability
+    '''
+    if 'tumor_samples' not in sample_indexes:
+        availability = CACHE_operations.CachedQuery(client, 'tumor_sample_availability', tumor_sample_availability_query,
+                                                    pancancer_release, persist=True)
+        samples = availability[['SampleBarcode', 'Study']].drop_duplicates()
+        available = [(modality, availability.loc[availability['modality'] == modality, ['SampleBarcode', 'Study']])
+                     for modality in ['expression', 'cn', 'mutation']]
+        sample_indexes['tumor_samples'] = SampleIndex(samples, available)
+    return(sample_indexes['tumor_samples'])
+
+
+def ClearSampleIndex(disk=False):
+    '''
+    Drops the sample indexes, disk=True also removes their persisted tables
+    '''
+    sample_indexes.clear()
+    for release, name in [(depmap_release, 'cell_line_info'), (depmap_release, 'cell_line_availability'),
+                          (demeter_release, 'shRNA_cell_lines'), (pancancer_release, 'tumor_sample_availability')]:
+        CACHE_operations.ClearQueryCache(release, disk, name)
@@ -1,91 +1,62 @@
 from google.cloud import bigquery
 project_id='syntheticlethality'
-client = bigquery.Client(project_id)
+try:
+    client = bigquery.Client(project_id)
+except:
+    #no Google credentials, a client has to be given with set_client
+    client = None
+
+#dataset releases the memoized reference lookups are keyed by
+depmap_release = 'DepMap_public_20Q3'
+demeter_release = 'DEMETER2_v6'
+import os
+import json
 import pandas as pd
 from scipy import stats 
 import statsmodels.stats.multitest as multi
 import numpy as np
+import zlib
+import CACHE_operations
+import STATS_operations
+import INDEX_operations
+import QUERY_operations
+
+def set_client(new_client):
+    '''
+    Replaces the BigQuery client used by this module, e.g. by a
+    BACKEND_operations.LocalClient to run on locally mirrored tables
+    '''
+    global client
+    client = new_client
 
 def GeneSymbol_standardization(Gene_list):
-    
-    query='''
-        SELECT *
-        FROM  `syntheticlethality.gene_information.gene_info_human`
-        where Gene in UNNEST(@input_gene_list)
-        '''
-    job_config = bigquery.QueryJobConfig(
-    query_parameters=[
-            bigquery.ArrayQueryParameter("input_gene_list", "STRING", Gene_list)
-        ]
-        )
-
-    id_map = client.query(query,  job_config=job_config).result().to_dataframe()
-
-    Gene_list_all = list(set(list(id_map['Alias'].values) + list(id_map['Gene'].values) ))
-
-
-    query1 = ''' 
-                select Hugo_Symbol
-                from `syntheticlethality.DepMap_public_20Q3.CCLE_mutation`
-                where Hugo_Symbol in UNNEST(@input_gene_list_new)
-                '''
-
-    job_config = bigquery.QueryJobConfig(
-    query_parameters=[
-            bigquery.ArrayQueryParameter("input_gene_list_new", "STRING", Gene_list_all)
-        ]
-        )
-
-    Mut_mat = client.query(query1, job_config=job_config).result().to_dataframe()
-    set_gene_CCLE = set(Mut_mat['Hugo_Symbol'])
+    '''
+    Maps every gene to its aliases present in the CCLE mutation table, using
+    the local gene index (INDEX_operations) instead of per call queries
+    '''
+    gene_index = INDEX_operations.GetGeneIndex(client)
+    set_gene_CCLE = gene_index.universe(client, 'CCLE_mutation')
 
     dic_gene_to_alias = {}
     output_gene_list = []
     for Gene in Gene_list:
-        dic_gene_to_alias[Gene] = set(id_map.loc[id_map['Gene'] == Gene]['Alias']).intersection(set_gene_CCLE)
-        if Gene in set(id_map['Gene']) and Gene in dic_gene_to_alias[Gene]:
+        dic_gene_to_alias[Gene] = gene_index.aliases(Gene).intersection(set_gene_CCLE)
+        if gene_index.has_gene(Gene) and Gene in dic_gene_to_alias[Gene]:
             output_gene_list.append(Gene)
         else:
             print(Gene + ":" + ','.join(list(dic_gene_to_alias[Gene])))
             for value in dic_gene_to_alias[Gene]:
-                if value in set(id_map['Alias']):
-                    output_gene_list.append(value) 
+                output_gene_list.append(value) 
             
     return(dic_gene_to_alias, output_gene_list)
 
 
 
 def GeneSymbol_standardization_output(Gene_list):
-    Gene_list = list(set(Gene_list))
-    
-    query='''
-        SELECT *
-        FROM  `syntheticlethality.gene_information.gene_info_human`
-        where Gene in UNNEST(@input_gene_list)
-        '''
-    job_config = bigquery.QueryJobConfig(
-    query_parameters=[
-            bigquery.ArrayQueryParameter("input_gene_list", "STRING", Gene_list)
-        ]
-        )
-
-    id_map = client.query(query,  job_config=job_config).result().to_dataframe()
-    alias_list = list(id_map['Alias'].values)
-    gene_list = list(id_map['Gene'].values) 
-    
-    
-
-    dic_alias_to_gene = {}
-    
-    for i in range(0,len(alias_list)):
-        dic_alias_to_gene[alias_list[i]] = gene_list[i]
-    
-    #result_gene_list = []
-    #for gene in Gene_list:
-    #    if gene in dic_alias_to_gene:
-    #        result_gene_list.append(dic_alias_to_gene[gene])
-    #    else:
-    #        result_gene_list.append(gene)
+    '''
+    Maps the aliases of the genes in Gene_list to their gene symbols
+    '''
+    dic_alias_to_gene = INDEX_operations.GetGeneIndex(client).alias_to_gene(set(Gene_list))
     return(dic_alias_to_gene)
 
 
@@ -94,27 +65,79 @@ def get_ccle_sample_info():
             SELECT DepMap_ID, CCLE_Name,primary_disease,TCGA_subtype
             FROM `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` 
             '''
-    sample_info = client.query(query).result().to_dataframe()
+    sample_info = CACHE_operations.CachedQuery(client, 'sample_info', query, depmap_release)
     return(sample_info)
 
+def clear_reference_cache(disk=False):
+    '''
+    Forgets the memoized sample lookups, e.g. after a table was updated
+    '''
+    CACHE_operations.ClearQueryCache(depmap_release, disk)
+    CACHE_operations.ClearQueryCache(demeter_release, disk)
+    INDEX_operations.ClearSampleIndex(disk)
+
+#variant classes counted as functional mutations
+functional_variants = ['Splice_Site',
+                     'Frame_Shift_Del',
+                     'Frame_Shift_Ins',
+                     'Nonstop_Mutation',
+                     'In_Frame_Del',
+                     'In_Frame_Ins',
+                     'Missense_Mutation',
+                     'Nonsense_Mutation',
+                     'Nonstop_Mutation',
+                     'Start_Codon_Del',
+                     'Start_Codon_Ins',
+                     'Start_Codon_SNP',
+                     'Stop_Codon_Del',
+                     'Stop_Codon_Del',
+                     'Stop_Codon_Ins',
+                     'De_novo_Start_OutOfFrame']
+
 def get_ccle_mutation_data():
     #Mutation matrix
     query = ''' 
             select Hugo_Symbol,DepMap_ID,Variant_Classification 
             from `syntheticlethality.DepMap_public_20Q3.CCLE_mutation`
             '''
-    Mut_mat = client.query(query).result().to_dataframe()
+    Mut_mat = QUERY_operations.FetchFrame(client.query(query), {'Hugo_Symbol': 'category', 'DepMap_ID': 'category',
+                                                                'Variant_Classification': 'category'})
     return(Mut_mat)
 
-def get_depmap_crispr_data():
-    import requests
-    from io import StringIO
-
-    url = "https://ndownloader.figshare.com/files/24613292"
-    req = requests.get(url)
-    data = StringIO(req.text)
+def get_ccle_mutation_matrix():
+    '''
+    CCLE mutation records as a compact INDEX_operations.MutationMatrix, which
+    Mutational_based_SL_pipeline accepts in place of get_ccle_mutation_data()
+    '''
+    Mut_mat = INDEX_operations.MutationMatrix(get_ccle_mutation_data())
+    return(Mut_mat)
 
-    Depmap_matrix = pd.read_csv(data )
+# figshare article (id, version) of the files read by load_figshare_csv, the
+# downloads are checked against the md5 figshare lists for them
+figshare_articles = {
+    24613292: (11791698, 2),  # DepMap 20Q3 Public, Achilles_gene_effect.csv
+    13515395: (6025238, 6)    # DEMETER2 data, D2_combined_gene_dep_scores.csv
+}
+
+def load_figshare_csv(file_id, use_cache=True):
+    '''
+    Reads a figshare csv file, through the local cache by default: the file is
+    downloaded once in chunks to disk, checked against figshare's md5 when its
+    article is in figshare_articles, and later loads read the parsed table back
+    from Parquet instead of parsing the csv again.
+    '''
+    if not use_cache:
+        return(pd.read_csv("https://ndownloader.figshare.com/files/" + str(file_id)))
+
+    key = 'figshare/' + str(file_id) + '/table'
+    data = CACHE_operations.LoadFrame(key)
+    if data is None:
+        data = pd.read_csv(CACHE_operations.FetchFigshareFile(file_id, article=figshare_articles.get(file_id)))
+        CACHE_operations.StoreFrame(key, data)
+    return(data)
+
+def get_depmap_crispr_data(use_cache=True):
+    Depmap_matrix = load_figshare_csv(24613292, use_cache)
     Depmap_matrix.index = Depmap_matrix['DepMap_ID']
     Depmap_matrix = Depmap_matrix.drop(['DepMap_ID'], axis=1)
     
@@ -127,14 +150,8 @@ def get_depmap_crispr_data():
 
     return(Depmap_matrix)
 
-def get_demeter_shRNA_data():
-    import requests
-    from io import StringIO
-    url = "https://ndownloader.figshare.com/files/13515395"
-    req = requests.get(url)
-    data = StringIO(req.text)
-    
-    Depmap_matrix = pd.read_csv(data )
+def get_demeter_shRNA_data(use_cache=True):
+    Depmap_matrix = load_figshare_csv(13515395, use_cache)
     
     gene_names_new = []
     for item in list(Depmap_matrix['Unnamed: 0']):
@@ -142,213 +159,496 @@ def get_demeter_shRNA_data():
         gene_names_new.append(name)
     Depmap_matrix.index = gene_names_new
     
-    sample_info = get_ccle_sample_info()
-    sample_map = {}
-    for i in range(0, sample_info.shape[0]):
-        Depmap_id = sample_info.iloc[i,0]
-        CCLE_Name = sample_info.iloc[i,1]
-        sample_map[CCLE_Name]  = Depmap_id
-
-    Matched_cellLines = []
-    for CCLE_Name in list(Depmap_matrix.columns):
-        if CCLE_Name not in sample_map:
-            print(CCLE_Name)
-        else:
-            Matched_cellLines.append(CCLE_Name)        
-    Depmap_matrix_sele = Depmap_matrix.loc[:,Matched_cellLines]
-    ACH_ID_list = []
-    for CCLE_Name in list(Depmap_matrix_sele.columns):
-        if CCLE_Name not in sample_map:
-            print(CCLE_Name)
-        else:
-            ACH_ID_list.append(sample_map[CCLE_Name])
-    Depmap_matrix_sele.columns = ACH_ID_list 
+    #CCLE names are matched to DepMap_IDs through the cell line index
+    ACH_ID_list = INDEX_operations.GetCellLineIndex(client).depmap_ids(Depmap_matrix.columns)
+    matched = pd.notna(ACH_ID_list)
+    for CCLE_Name in Depmap_matrix.columns[~matched]:
+        print(CCLE_Name)
+    Depmap_matrix_sele = Depmap_matrix.loc[:, matched]
+    Depmap_matrix_sele.columns = ACH_ID_list[matched]
     Depmap_matrix_sele = Depmap_matrix_sele.transpose()
     return(Depmap_matrix_sele)
 
-def Mutational_based_SL_pipeline(tumor_type, mut_gene, Mut_mat, Depmap_matrix, datatype ):
-    
-    def Cohen_dist(x,y):
-
-        n1 = len(x)
-        n2 = len(y)
-        s = np.sqrt(((n1 - 1)*(np.std(x))*(np.std(x)) + (n2 - 1) * (np.std(y)) * (np.std(y))) / (n1 + n2 -2))
-        d = (np.mean(x) - np.mean(y)) / s
-        return(d)
-    
-    
-    #selection of cancer cell lines in certain tumor types  
-    query = ''' 
-            SELECT DepMap_ID, primary_disease,TCGA_subtype
-            FROM `syntheticlethality.DepMap_public_20Q3.sample_info_Depmap_withTCGA_labels` 
-            '''
-    sample_info = client.query(query).result().to_dataframe()
-    
-    pancancer_cls = (sample_info.loc[~sample_info['primary_disease'].isin(['Non-Cancerous','Unknown','Engineered','Immortalized'])])
-    pancancer_cls = pancancer_cls.loc[~(pancancer_cls['primary_disease'].isna())]
-    
-    if tumor_type == ['pancancer']:
-        cl_sele = list(pancancer_cls['DepMap_ID'].values)
-
-    else:
-        tumor_selected = tumor_type
-        cl_sele = sample_info.loc[sample_info['primary_disease'].isin((tumor_selected))]['DepMap_ID']  
-        cl_sele = list(set(list(Depmap_matrix.index.values)).intersection(set(cl_sele)))
+def ttest_kd_values(values, mut_weights, wt_weights):
+    '''
+    Array version of ttest_kd_matrix, values is a knockdown gene x cell line
+    float matrix. Returns n_mut, n_wt, tstat, pvalue and ES arrays.
+    '''
+    n_mut, mean_mut, m2_mut = STATS_operations.moments(values, np.asarray(mut_weights, dtype=float)[:, None])
+    n_wt, mean_wt, m2_wt = STATS_operations.moments(values, np.asarray(wt_weights, dtype=float)[:, None])
+    n_mut, mean_mut, m2_mut, n_wt, mean_wt, m2_wt = [x[:, 0] for x in [n_mut, mean_mut, m2_mut, n_wt, mean_wt, m2_wt]]
+    tstat, pvalue, es = STATS_operations.ttest_from_moments(n_mut, mean_mut, m2_mut, n_wt, mean_wt, m2_wt)
+    return(n_mut, n_wt, tstat, pvalue, es)
+
+def ttest_kd_matrix(Depmap_matrix_sele, mut_weights, wt_weights):
+    '''
+    Student's t-test and Cohen's d of the mutant versus the WT samples for every
+    knockdown gene (row of Depmap_matrix_sele) at once.
+    mut_weights and wt_weights are per-column masks or counts, a cell line listed
+    twice in a group counts twice as it does in a list based .loc selection.
+    NaN values are left out of each group, the returned frame is indexed by the
+    knockdown genes and holds n_mut, n_wt, tstat, pvalue and ES.
+    '''
+    values = np.ascontiguousarray(Depmap_matrix_sele.values, dtype=np.float64)
+    n_mut, n_wt, tstat, pvalue, es = ttest_kd_values(values, mut_weights, wt_weights)
+
+    result = pd.DataFrame({"n_mut": n_mut.astype(int),
+                           "n_wt": n_wt.astype(int),
+                           "tstat": tstat,
+                           "pvalue": pvalue,
+                           "ES": es},
+                          index=Depmap_matrix_sele.index)
+    return(result)
 
-        
-    #selection of cell lines with mutation data
-    query = ''' 
-            select DepMap_ID from `syntheticlethality.DepMap_public_20Q3.CCLE_mutation`
-            group by DepMap_ID
-            '''
-    samples_with_mut = client.query(query).result().to_dataframe()
-    samples_with_mut = set(samples_with_mut['DepMap_ID'])
-    
-    
-    selected_variants = ['Splice_Site',
-                     'Frame_Shift_Del',
-                     'Frame_Shift_Ins',
-                     'Nonstop_Mutation',
-                     'In_Frame_Del',
-                     'In_Frame_Ins',
-                     'Missense_Mutation',
-                     'Nonsense_Mutation',
-                     'Nonstop_Mutation',
-                     'Start_Codon_Del',
-                     'Start_Codon_Ins',
-                     'Start_Codon_SNP',
-                     'Stop_Codon_Del',
-                     'Stop_Codon_Del',
-                     'Stop_Codon_Ins',
-                     'De_novo_Start_OutOfFrame']
-    
-    #selection of cell lines with crispr or shRNA knockdown data
-    samples_depmap_newname = []
+def ttest_kd_mut_blocks(Depmap_matrix_sele, mut_weights, wt_weights, block_size=256):
+    '''
+    Batch version of ttest_kd_matrix for many mutated genes. mut_weights and
+    wt_weights are cell line x mutated gene matrices (same column order as
+    Depmap_matrix_sele), the group counts, sums and sums of squares of every
+    (knockdown gene, mutated gene) pair come from matrix products against the
+    NaN masked dependency matrix, block_size mutated genes at a time.
+    Yields (start, stats) for every block, stats holds n_mut, pvalue and ES as
+    knockdown gene x block arrays for the mutated genes from column start on,
+    so only one block of results is in memory at a time.
+    '''
+    values = np.asarray(Depmap_matrix_sele.values, dtype=float)
+
+    mut_weights = np.asarray(mut_weights, dtype=float)
+    wt_weights = np.asarray(wt_weights, dtype=float)
+    for start in range(0, mut_weights.shape[1], block_size):
+        block = slice(start, start + block_size)
+        n_mut, mean_mut, m2_mut = STATS_operations.moments(values, mut_weights[:, block])
+        n_wt, mean_wt, m2_wt = STATS_operations.moments(values, wt_weights[:, block])
+        tstat, pvalue, es = STATS_operations.ttest_from_moments(n_mut, mean_mut, m2_mut, n_wt, mean_wt, m2_wt)
+        yield start, {"n_mut": n_mut, "pvalue": pvalue, "ES": es}
+
+def ttest_kd_mut_matrix(Depmap_matrix_sele, mut_weights, wt_weights, block_size=256):
+    '''
+    ttest_kd_mut_blocks for all mutated genes at once, returns n_mut, pvalue
+    and ES as knockdown gene x mutated gene arrays.
+    '''
+    blocks = [stats for start, stats in ttest_kd_mut_blocks(Depmap_matrix_sele, mut_weights, wt_weights, block_size)]
+    n_kd = Depmap_matrix_sele.shape[0]
+    return({key: np.concatenate([stats[key] for stats in blocks], axis=1) if len(blocks) > 0 else np.zeros((n_kd, 0))
+            for key in ["n_mut", "pvalue", "ES"]})
+
+def select_mdslp_samples(tumor_type, Depmap_matrix, datatype):
+    '''
+    Cell lines of the selected tumor types with mutation data and crispr or
+    shRNA knockdown data.
+    '''
+    #cell lines with mutation data and crispr or shRNA knockdown data, from
+    #the modality bitmask of the cell line index
     if datatype == "Crispr":
-        query = ''' 
-                select DepMap_ID from `syntheticlethality.DepMap_public_20Q3.Achilles_gene_effect`
-                group by DepMap_ID
-                '''
-        samples_depmap = client.query(query).result().to_dataframe()
-        samples_depmap = set(samples_depmap['DepMap_ID'])
-        for sample in samples_depmap:
-            samples_depmap_newname.append(sample)
-        
+        modalities = ['mutation', 'crispr']
     elif datatype == "shRNA":
-        query = ''' 
-                select CCLE_ID from `syntheticlethality.DEMETER2_v6.D2_combined_gene_dep_score`
-                group by CCLE_ID
-                '''
-        samples_depmap = client.query(query).result().to_dataframe()
-        samples_depmap = set(samples_depmap['CCLE_ID'])
-        
-        sample_info = get_ccle_sample_info()
-        sample_map = {}
-        for i in range(0, sample_info.shape[0]):
-            Depmap_id = sample_info.iloc[i,0]
-            CCLE_Name = sample_info.iloc[i,1]
-            sample_map[CCLE_Name]  = Depmap_id
-            
-        for sample in samples_depmap:
-            if sample in sample_map:
-                samples_depmap_newname.append(sample_map[sample])
+        modalities = ['mutation', 'shRNA']
     else:
         print("Data type must be 'Crispr' or 'shRNA'!")
-            
-            
-    #The intersection of cell lines with mutation and knockdown or knockout data
-    Samples_with_mut_kd = samples_with_mut.intersection(cl_sele).intersection(samples_depmap_newname)
-    
-    Mut_mat_sele1 = Mut_mat.loc[Mut_mat['DepMap_ID'].isin(Samples_with_mut_kd)]
-    Mut_mat_sele2 = Mut_mat_sele1.loc[Mut_mat_sele1['Variant_Classification'].isin(selected_variants)]
-    
-    Mut_mat_sele3 = Mut_mat_sele2.loc[Mut_mat_sele2['Hugo_Symbol'].isin(mut_gene),['Hugo_Symbol','DepMap_ID']]
-    Depmap_matrix_sele = Depmap_matrix.loc[Samples_with_mut_kd,:].transpose()
-
-    Gene_mut_list = []
-    Gene_kd_list = []
-    p_list = []
-    es_list = []
-    size_mut = []
-    FDR_List = []
+        return(set())
+    cell_line_index = INDEX_operations.GetCellLineIndex(client)
+
+    #selection of cancer cell lines in certain tumor types
+    if tumor_type == ['pancancer']:
+        keep = cell_line_index.rows(modalities, exclude={'primary_disease': INDEX_operations.non_cancer_diseases})
+    else:
+        keep = cell_line_index.rows(modalities)
+        keep &= pd.Series(cell_line_index.values['primary_disease']).isin(tumor_type).values
+        keep &= np.isin(cell_line_index.values['DepMap_ID'], list(Depmap_matrix.index.values))
+
+    Samples_with_mut_kd = set(cell_line_index.values['DepMap_ID'][keep])
+    return(Samples_with_mut_kd)
+
+def mdslp_block_frame(Gene, kd_stats):
+    '''
+    Output rows of one mutated gene from its knockdown gene statistics, with
+    the FDR correction within the gene
+    '''
+    block = pd.DataFrame({"Gene_mut": [Gene]*kd_stats.shape[0],
+                          "Gene_kd": list(kd_stats.index),
+                          "Mutated_samples": kd_stats['n_mut'].values,
+                          "pvalue": kd_stats['pvalue'].values,
+                          "ES": kd_stats['ES'].values,
+                          "FDR_by_gene": np.zeros(kd_stats.shape[0])})
+    if block.shape[0] > 0:
+        block['FDR_by_gene'] = STATS_operations.grouped_multipletests(block['pvalue'], None, 'fdr_bh')
+    return(block)
+
+def add_gene_symbols(pairs, dic_alias_gene):
+    '''
+    Adds the Gene_mut_symbol and Gene_kd_symbol columns, genes that are not an
+    alias in dic_alias_gene keep their name
+    '''
+    pairs.insert(pairs.columns.get_loc('Gene_mut') + 1, 'Gene_mut_symbol',
+                 [dic_alias_gene.get(gene, gene) for gene in pairs['Gene_mut']])
+    pairs.insert(pairs.columns.get_loc('Gene_kd') + 1, 'Gene_kd_symbol',
+                 [dic_alias_gene.get(gene, gene) for gene in pairs['Gene_kd']])
+    return(pairs)
+
+def mdslp_result_frame(tumor_type, blocks):
+    '''
+    Builds the Mutational_based_SL_pipeline output from the per mutated gene
+    blocks, adding the gene symbols and the analysis level FDR.
+    '''
     result = pd.DataFrame()
-    #for Gene in list(mut_gene['HGNC_gene_symbol']):
-
-    for Gene in mut_gene:
-    #for Gene in range(0,1):
-        print("Gene mutated: " + Gene)
-        p_list_curr = []
-        Mut_group = list(Mut_mat_sele3.loc[Mut_mat_sele3['Hugo_Symbol'] == Gene]['DepMap_ID'].values)
-        #Mut_group = list(Mut_mat_sele3.loc[Mut_mat_sele3['Hugo_Symbol'].isin(mut_gene) ]['DepMap_ID'].values)
-        WT_group = list(set(Samples_with_mut_kd) - set(Mut_group))
-        #print(len(Mut_group))
-        print("Number of samples with mutation: " + str(len(Mut_group)))
-        
-        for Gene_kd in list(Depmap_matrix_sele.index.values):
-            D_mut_new = Depmap_matrix_sele.loc[Gene_kd,Mut_group].values
-            D_wt_new = Depmap_matrix_sele.loc[Gene_kd,WT_group].values
-
-            nan_array = np.isnan(D_mut_new)
-            not_nan_array = ~ nan_array
-            D_mut_new = D_mut_new[not_nan_array]
-
-            nan_array = np.isnan(D_wt_new)
-            not_nan_array = ~ nan_array
-            D_wt_new = D_wt_new[not_nan_array]
-            
-            if len(D_mut_new) > 5:
-                
-
-                Sci_test = stats.ttest_ind(D_mut_new, D_wt_new, nan_policy = 'omit')
-                pvalue = Sci_test[1]
-                if np.isnan(pvalue) == False:
-                    size_mut.append(len(D_mut_new))
-                    p_list_curr.append(pvalue)
-                    Size_effect =Cohen_dist(D_mut_new, D_wt_new)
-                    es_list.append(Size_effect)
-                    Gene_mut_list.append(Gene)
-                    Gene_kd_list.append(Gene_kd)
-
-        if len(p_list_curr) > 0:
-
-            FDR_List_table = multi.multipletests(p_list_curr, alpha=0.05, method='fdr_bh', is_sorted=False)[1]
-            p_list = p_list + p_list_curr
-            FDR_List = FDR_List + list(FDR_List_table)
-            
-    if len(p_list) > 0:
-        FDR_List_table = multi.multipletests(p_list, alpha=0.05, method='fdr_bh', is_sorted=False)[1]
-        FDR_List_allExp = list(FDR_List_table)
-    
-        Gene_mut_list_symbol = []
-        Gene_mut_list_set = list(set(Gene_mut_list))
-
-        dic_alias_gene = GeneSymbol_standardization_output(Gene_kd_list)
-        Gene_mut_list_Symbol = []
-        for gene in Gene_mut_list:
-            if gene in dic_alias_gene:
-                Gene_mut_list_Symbol.append(dic_alias_gene[gene])
-            else:
-                Gene_mut_list_Symbol.append(gene)
-
-        Gene_kd_list_symbol = []
-        for gene in Gene_kd_list:
-            if gene in dic_alias_gene:
-                Gene_kd_list_symbol.append(dic_alias_gene[gene])
-            else:
-                Gene_kd_list_symbol.append(gene)
-
-        result = pd.DataFrame({"Gene_mut": Gene_mut_list, 
-                               "Gene_mut_symbol": Gene_mut_list_Symbol,
-                               "Gene_kd": Gene_kd_list, 
-                               "Gene_kd_symbol":Gene_kd_list_symbol,
-                               "Mutated_samples":size_mut,
-                               "pvalue": p_list, 
-                               "ES":es_list, 
-                               "FDR_by_gene": FDR_List,
-                               "FDR_all_exp":FDR_List_allExp,
-                               "Tumor_type":[','.join(tumor_type)]*len(FDR_List_allExp)
-                          })
+    if sum(block.shape[0] for block in blocks) > 0:
+        result = pd.concat(blocks, ignore_index=True)
+        result = add_gene_symbols(result, GeneSymbol_standardization_output(result['Gene_kd']))
+        result.insert(result.columns.get_loc('FDR_by_gene') + 1, 'FDR_all_exp',
+                      multi.multipletests(result['pvalue'], alpha=0.05, method='fdr_bh', is_sorted=False)[1])
+        result['Tumor_type'] = ','.join(tumor_type)
+    return(result)
+
+def finished_mdslp_parts(output_dir):
+    '''
+    Mutated genes already written to output_dir, by their position in mut_gene
+    '''
+    if not os.path.isdir(output_dir):
+        return({})
+    parts = [f[len('part-'):-len('.parquet')].split('-', 1) for f in os.listdir(output_dir)
+             if f.startswith('part-') and f.endswith('.parquet')]
+    return({int(position): Gene for position, Gene in parts})
+
+def check_mdslp_call(output_dir, call):
+    '''
+    Saves the arguments of a streamed run as _mdslp_call.json in output_dir, or
+    checks them against the saved ones when the run is resumed. Returns False
+    when output_dir holds parts of a different call.
+    '''
+    call_file = os.path.join(output_dir, '_mdslp_call.json')
+    call = json.loads(json.dumps(call, default=str))
+    if os.path.exists(call_file):
+        with open(call_file) as f:
+            if json.load(f) != call:
+                print(output_dir + " holds the output of a call with different arguments, use another output_dir")
+                return(False)
+        return(True)
+    if len(finished_mdslp_parts(output_dir)) > 0:
+        print(output_dir + " holds parts without their call arguments, use another output_dir")
+        return(False)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(call_file + '.tmp', 'w') as f:
+        json.dump(call, f)
+    os.replace(call_file + '.tmp', call_file)
+    return(True)
+
+#column types of the streamed Mutational_based_SL_pipeline parts, an empty part
+#would otherwise get double or null columns that do not merge with the others
+mdslp_part_types = {'Gene_mut': 'string', 'Gene_mut_symbol': 'string',
+                    'Gene_kd': 'string', 'Gene_kd_symbol': 'string',
+                    'Mutated_samples': 'int64', 'pvalue': 'float64', 'ES': 'float64',
+                    'FDR_by_gene': 'float64', 'FDR_all_exp': 'float64', 'Tumor_type': 'string'}
+
+def write_mdslp_parquet(part_file, block):
+    '''
+    Writes a part with the mdslp_part_types schema, the part only appears
+    under its final name once it is complete
+    '''
+    import pyarrow as pa
+
+    schema = pa.schema([(column, mdslp_part_types[column]) for column in block.columns])
+    block.to_parquet(part_file + '.tmp', index=False, schema=schema)
+    os.replace(part_file + '.tmp', part_file)
+
+def write_mdslp_part(output_dir, position, Gene, block):
+    '''
+    Writes one mutated gene block as part-<position>-<Gene>.parquet
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    write_mdslp_parquet(os.path.join(output_dir, 'part-' + str(position).zfill(6) + '-' + Gene + '.parquet'), block)
+
+def finalize_mdslp_output(output_dir):
+    '''
+    Adds the analysis level FDR_all_exp to a streamed Mutational_based_SL_pipeline
+    output. The correction reads only the pvalue column of the parts, which are
+    then rewritten one at a time. Running it again recomputes the column.
+    '''
+    part_files = sorted(f for f in os.listdir(output_dir) if f.startswith('part-') and f.endswith('.parquet'))
+    part_files = [os.path.join(output_dir, f) for f in part_files]
+    pvalues = [pd.read_parquet(f, columns=['pvalue'])['pvalue'].values for f in part_files]
+    n_pairs = sum(len(x) for x in pvalues)
+    if n_pairs == 0:
+        return(output_dir)
+    FDR_all_exp = multi.multipletests(np.concatenate(pvalues), alpha=0.05, method='fdr_bh', is_sorted=False)[1]
+
+    start = 0
+    for part_file, part_pvalues in zip(part_files, pvalues):
+        block = pd.read_parquet(part_file)
+        if 'FDR_all_exp' in block.columns:
+            block = block.drop(columns=['FDR_all_exp'])
+        block.insert(block.columns.get_loc('FDR_by_gene') + 1, 'FDR_all_exp', FDR_all_exp[start:start + len(part_pvalues)])
+        start = start + len(part_pvalues)
+        write_mdslp_parquet(part_file, block)
+    return(output_dir)
+
+#dependency matrix attached by the worker processes of Mutational_based_SL_pipeline
+shared_depmap = {}
+
+def attach_shared_depmap(shm_name, shape):
+    '''
+    Process pool initializer, maps the dependency matrix placed in shared memory
+    by the parent process without copying it.
+    '''
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    shared_depmap['shm'] = shm
+    shared_depmap['values'] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+def ttest_shared_depmap(mut_weights, wt_weights):
+    '''
+    Worker task, ttest_kd_values on the shared dependency matrix.
+    '''
+    return(ttest_kd_values(shared_depmap['values'], mut_weights, wt_weights))
+
+def score_mutated_genes_parallel(Depmap_matrix_sele, weights, n_workers):
+    '''
+    Runs ttest_kd_values for every (mut_weights, wt_weights) pair in weights on a
+    pool of n_workers processes. The dependency matrix is copied once into shared
+    memory, the results are returned in the order of weights.
+    '''
+    from multiprocessing import shared_memory
+    from concurrent.futures import ProcessPoolExecutor
+
+    values = np.ascontiguousarray(Depmap_matrix_sele.values, dtype=np.float64)
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    try:
+        shared_values = np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)
+        shared_values[:] = values
+        del values
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=attach_shared_depmap,
+                                 initargs=(shm.name, shared_values.shape)) as executor:
+            futures = [executor.submit(ttest_shared_depmap, mut_weights, wt_weights)
+                       for mut_weights, wt_weights in weights]
+            results = [future.result() for future in futures]
+        del shared_values
+    finally:
+        shm.close()
+        shm.unlink()
+    return(results)
+
+def permutation_pvalues(values, mut_weights, n_permutations=10000, block_size=500, min_exceed=10, rng=None):
+    '''
+    Empirical two sided p-values of the mutant versus WT t statistic for every
+    row of values (knockdown gene x cell line). The mutation weights are
+    permuted across the cell lines block_size permutations at a time, each
+    block is a cell line x permutation weight matrix scored with matrix
+    products, so memory stays at rows x block_size.
+    A row stops being permuted once min_exceed permuted |t| reached the observed
+    one (Besag and Clifford sequential p-value, exceedances / permutations
+    done), the other rows get (exceedances + 1) / (permutations + 1).
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+    mut_weights = np.asarray(mut_weights, dtype=float)
+    values = np.asarray(values, dtype=float)
+
+    def abs_tstat(rows, mut_w):
+        wt_w = (mut_w == 0).astype(float)
+        n_mut, mean_mut, m2_mut = STATS_operations.moments(values[rows], mut_w)
+        n_wt, mean_wt, m2_wt = STATS_operations.moments(values[rows], wt_w)
+        return np.abs(STATS_operations.ttest_from_moments(n_mut, mean_mut, m2_mut, n_wt, mean_wt, m2_wt)[0])
+
+    n_rows = values.shape[0]
+    observed = abs_tstat(np.arange(n_rows), mut_weights[:, None])[:, 0]
+    #permutations equal to the observed labels must count despite round-off
+    threshold = observed * (1 - 1e-12)
+    exceed = np.zeros(n_rows)
+    done = np.zeros(n_rows)
+    active = ~np.isnan(observed)
+    n_done = 0
+    while n_done < n_permutations and active.any():
+        size = min(block_size, n_permutations - n_done)
+        perm_weights = rng.permuted(np.repeat(mut_weights[:, None], size, axis=1), axis=0)
+        rows = np.flatnonzero(active)
+        with np.errstate(invalid='ignore'):
+            exceed[rows] += (abs_tstat(rows, perm_weights) >= threshold[rows, None]).sum(axis=1)
+        done[rows] += size
+        active[rows] = exceed[rows] < min_exceed
+        n_done += size
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pvalue = np.where(exceed >= min_exceed, exceed / done, (exceed + 1) / (done + 1))
+    pvalue[np.isnan(observed)] = np.nan
+    return(pvalue)
+
+def permutation_blocks(Depmap_matrix_sele, gene_blocks, gene_weights, n_permutations, seed):
+    '''
+    Replaces the t-test p-values of the (mutated gene, knockdown gene
+    statistics) blocks by permutation p-values. Every mutated gene gets its own
+    random stream spawned from seed, so results do not depend on the gene order.
+    '''
+    seeds = np.random.SeedSequence(seed)
+    for Gene, kd_stats in gene_blocks:
+        rng = np.random.default_rng([seeds.entropy, zlib.crc32(Gene.encode())])
+        kd_stats = kd_stats.copy()
+        if kd_stats.shape[0] > 0:
+            values = Depmap_matrix_sele.loc[kd_stats.index].values
+            kd_stats['pvalue'] = permutation_pvalues(values, gene_weights[Gene], n_permutations, rng=rng)
+        yield Gene, kd_stats
+
+def pair_stats_column(pair_stats, j, kd_genes):
+    '''
+    Knockdown gene statistics of column j of a ttest_kd_mut_blocks block, with
+    the n_mut > 5 and non-NaN p-value rules applied
+    '''
+    keep = (pair_stats['n_mut'][:, j] > 5) & ~np.isnan(pair_stats['pvalue'][:, j])
+    kd_stats = pd.DataFrame({"n_mut": pair_stats['n_mut'][keep, j].astype(int),
+                             "pvalue": pair_stats['pvalue'][keep, j],
+                             "ES": pair_stats['ES'][keep, j]},
+                            index=np.asarray(kd_genes)[keep])
+    return(kd_stats)
+
+def batch_gene_blocks(Depmap_matrix_sele, mut_gene, mut_weights, wt_weights):
+    '''
+    (mutated gene, knockdown gene statistics) blocks of the genes in mut_gene,
+    column i of mut_weights and wt_weights holds the weights of mut_gene[i].
+    The genes are scored by ttest_kd_mut_blocks and every block of results is
+    dropped once its genes have been consumed.
+    '''
+    for start, pair_stats in ttest_kd_mut_blocks(Depmap_matrix_sele, mut_weights, wt_weights):
+        for j in range(pair_stats['n_mut'].shape[1]):
+            yield mut_gene[start + j], pair_stats_column(pair_stats, j, Depmap_matrix_sele.index)
+
+def mdslp_gene_blocks_result(tumor_type, gene_blocks):
+    '''
+    Collects the (mutated gene, knockdown gene statistics) blocks in order,
+    adds the per mutated gene FDR and builds the result frame.
+    '''
+    blocks = [mdslp_block_frame(Gene, kd_stats) for Gene, kd_stats in gene_blocks]
+    result = mdslp_result_frame(tumor_type, blocks)
     return(result)
-    
 
+def stream_mdslp_gene_blocks(tumor_type, gene_blocks, positions, kd_genes, output_dir):
+    '''
+    Writes every (mutated gene, knockdown gene statistics) block to output_dir
+    as soon as it is computed, positions are the places of the genes in mut_gene.
+    The gene symbols come from the aliases of all knockdown genes in kd_genes.
+    '''
+    dic_alias_gene = GeneSymbol_standardization_output(kd_genes)
+    for position, (Gene, kd_stats) in zip(positions, gene_blocks):
+        block = add_gene_symbols(mdslp_block_frame(Gene, kd_stats), dic_alias_gene)
+        block['Tumor_type'] = ','.join(tumor_type)
+        write_mdslp_part(output_dir, position, Gene, block)
+
+def Mutational_based_SL_pipeline(tumor_type, mut_gene, Mut_mat, Depmap_matrix, datatype, batch=False, n_workers=1,
+                                 pvalue_method='ttest', n_permutations=10000, seed=None, output_dir=None):
+    '''
+    Mutation dependent SL inference, the knockdown effects of every gene in
+    Depmap_matrix are compared between cell lines with and without functional
+    mutations of each gene in mut_gene. Mut_mat is the get_ccle_mutation_data()
+    frame or, cheaper to reuse across calls, get_ccle_mutation_matrix().
+    With batch=True all (mutated gene, knockdown gene) pairs are scored together
+    from a mutation indicator matrix, which is much faster for long mut_gene lists.
+    With n_workers > 1 the mutated genes are scored on a process pool sharing one
+    copy of the dependency matrix, the FDR correction stays in the main process.
+    n_workers only applies to batch=False, the batch matrix products already use
+    the threads of the BLAS library, so batch=True ignores it with a message.
+    pvalue_method='permutation' replaces the t-test p-values of the tested pairs
+    by empirical p-values from up to n_permutations permutations of the mutation
+    labels (see permutation_pvalues), seed makes them reproducible.
+    With output_dir the rows of each mutated gene are written to a Parquet part
+    in output_dir as soon as the gene is done instead of being kept in memory.
+    Rerunning the same call resumes after the last finished gene, a call with
+    other arguments than the ones saved in output_dir is refused. FDR_all_exp
+    is added by finalize_mdslp_output at the end and output_dir is returned
+    (read it with pd.read_parquet(output_dir)).
+    '''
+    if pvalue_method not in ['ttest', 'permutation']:
+        print("pvalue_method can be either ttest or permutation")
+        return()
+    positions = list(range(len(mut_gene)))
+    if output_dir is not None:
+        call = {'tumor_type': list(tumor_type), 'mut_gene': list(mut_gene), 'datatype': datatype,
+                'pvalue_method': pvalue_method, 'n_permutations': n_permutations, 'seed': seed}
+        if not check_mdslp_call(output_dir, call):
+            return()
+        finished = finished_mdslp_parts(output_dir)
+        if any(position >= len(mut_gene) or mut_gene[position] != Gene for position, Gene in finished.items()):
+            print(output_dir + " holds parts of other mutated genes, use another output_dir")
+            return()
+        positions = [i for i in positions if i not in finished]
+        if len(finished) > 0:
+            print("Resuming, " + str(len(finished)) + " mutated genes are already in " + output_dir)
+        mut_gene = [mut_gene[i] for i in positions]
+        if len(mut_gene) == 0:
+            return(finalize_mdslp_output(output_dir))
+    if not isinstance(Mut_mat, INDEX_operations.MutationMatrix):
+        Mut_mat = INDEX_operations.MutationMatrix(Mut_mat)
+    Samples_with_mut_kd = select_mdslp_samples(tumor_type, Depmap_matrix, datatype)
+    Depmap_matrix_sele = Depmap_matrix.loc[list(Samples_with_mut_kd),:].transpose()
+    genes = list(dict.fromkeys(mut_gene))
+    #a cell line with several mutation records of a gene counts several times
+    indicator = Mut_mat.record_counts(Depmap_matrix_sele.columns, genes, functional_variants)
+    gene_weights = {Gene: indicator[Gene].values for Gene in genes}
+
+    if batch:
+        if n_workers > 1:
+            print("n_workers is ignored with batch=True, the matrix products use the BLAS threads")
+        print("Scoring " + str(len(genes)) + " mutated genes against " + str(Depmap_matrix_sele.shape[0]) + " knockdown genes")
+        mut_weights = np.column_stack([gene_weights[Gene] for Gene in mut_gene])
+        gene_blocks = batch_gene_blocks(Depmap_matrix_sele, mut_gene, mut_weights, (mut_weights == 0))
 
+    else:
+        Group_weights = [(gene_weights[Gene], (gene_weights[Gene] == 0).astype(float)) for Gene in mut_gene]
+        if n_workers > 1:
+            parallel_stats = score_mutated_genes_parallel(Depmap_matrix_sele, Group_weights, n_workers)
+
+        def serial_blocks():
+            for i, Gene in enumerate(mut_gene):
+                print("Gene mutated: " + Gene)
+                print("Number of samples with mutation: " + str(int(Group_weights[i][0].sum())))
+                if n_workers > 1:
+                    n_mut, n_wt, tstat, pvalue, es = parallel_stats[i]
+                    kd_stats = pd.DataFrame({"n_mut": n_mut.astype(int), "pvalue": pvalue, "ES": es},
+                                            index=Depmap_matrix_sele.index)
+                else:
+                    kd_stats = ttest_kd_matrix(Depmap_matrix_sele, Group_weights[i][0], Group_weights[i][1])
+                kd_stats = kd_stats.loc[(kd_stats['n_mut'] > 5) & ~(kd_stats['pvalue'].isna())]
+                yield Gene, kd_stats
+        gene_blocks = serial_blocks()
+
+    if pvalue_method == 'permutation':
+        gene_blocks = permutation_blocks(Depmap_matrix_sele, gene_blocks, gene_weights, n_permutations, seed)
+
+    if output_dir is not None:
+        stream_mdslp_gene_blocks(tumor_type, gene_blocks, positions, list(Depmap_matrix_sele.index), output_dir)
+        return(finalize_mdslp_output(output_dir))
+    result = mdslp_gene_blocks_result(tumor_type, gene_blocks)
+    return(result)
+
+def Mutational_based_SL_sweep(tumor_types, mut_gene, Mut_mat, Depmap_matrix, datatype):
+    '''
+    Runs Mutational_based_SL_pipeline(tumor_type, mut_gene, ...) for every
+    tumor_type in tumor_types (a list of tumor type lists such as
+    [['pancancer'], ['Lung Cancer']], or 'all' for pancancer and every
+    primary_disease) in one pass. The dependency matrix is aligned and the
+    mutation matrix built once for all cell lines, each tumor type only adds a
+    cell line mask to the grouped sums. Returns one long frame, FDR_by_gene and
+    FDR_all_exp are computed within each tumor type.
+    '''
+    if tumor_types == 'all':
+        sample_info = get_ccle_sample_info()
+        diseases = sample_info.loc[~sample_info['primary_disease'].isin(['Non-Cancerous','Unknown','Engineered','Immortalized']), 'primary_disease']
+        tumor_types = [['pancancer']] + [[x] for x in sorted(set(diseases.dropna()))]
+
+    strata_samples = [select_mdslp_samples(tumor_type, Depmap_matrix, datatype) for tumor_type in tumor_types]
+    all_samples = [x for x in Depmap_matrix.index if any(x in samples for samples in strata_samples)]
+    Depmap_matrix_sele = Depmap_matrix.loc[all_samples,:].transpose()
+    if not isinstance(Mut_mat, INDEX_operations.MutationMatrix):
+        Mut_mat = INDEX_operations.MutationMatrix(Mut_mat)
+
+    genes = list(dict.fromkeys(mut_gene))
+    indicator = Mut_mat.record_counts(Depmap_matrix_sele.columns, genes, functional_variants)
+    mut_weights = np.column_stack([indicator[Gene].values for Gene in mut_gene])
+    wt_weights = (mut_weights == 0)
+
+    #one tumor type at a time, its cell line mask applied to the gene weights,
+    #so only one block of results is in memory
+    print("Scoring " + str(len(genes)) + " mutated genes in " + str(len(tumor_types)) + " tumor types")
+    results = []
+    for tumor_type, samples in zip(tumor_types, strata_samples):
+        mask = Depmap_matrix_sele.columns.isin(list(samples))[:, None]
+        gene_blocks = batch_gene_blocks(Depmap_matrix_sele, mut_gene, mut_weights * mask, wt_weights * mask)
+        results.append(mdslp_gene_blocks_result(tumor_type, gene_blocks))
+    result = pd.concat(results, ignore_index=True)
+    return(result)
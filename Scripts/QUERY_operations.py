@@ -0,0 +1,488 @@
+import sys
+import copy
+import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    from google.api_core import exceptions as api_exceptions
+    retryable_errors = (api_exceptions.TooManyRequests, api_exceptions.InternalServerError,
+                        api_exceptions.BadGateway, api_exceptions.ServiceUnavailable,
+                        api_exceptions.GatewayTimeout, ConnectionError, TimeoutError)
+except ImportError:
+    retryable_errors = (ConnectionError, TimeoutError)
+
+
+# callers of the queries run by a QueryExecutor, read by TelemetryClient on the pool threads
+query_context = threading.local()
+
+# modules whose functions only pass the queries on, skipped when naming the caller of a query
+plumbing_modules = {__name__, 'CACHE_operations', 'BACKEND_operations', 'threading', 'concurrent.futures.thread'}
+
+
+class QueryBudgetError(Exception):
+    '''
+    Raised by TelemetryClient for a query whose dry run exceeds the byte budget
+    '''
+
+
+def CallPath(depth=5):
+    '''
+    Names of the functions that issued the current query, innermost first,
+    skipping the client wrappers, the cache and the thread pool
+    '''
+    callers = getattr(query_context, 'callers', None)
+    if callers is not None:
+        return(callers)
+    names = []
+    frame = sys._getframe(1)
+    while frame is not None and len(names) < depth:
+        if frame.f_globals.get('__name__') not in plumbing_modules and frame.f_code.co_name != '<module>':
+            names.append(frame.f_code.co_name)
+        frame = frame.f_back
+    return(tuple(names))
+
+
+def QueryKey(sql, job_config=None, options=None):
+    '''
+    Identifies a query by its text, the values of its parameters and the
+    other client.query arguments (location, job_id_prefix, timeout...)
+    '''
+    parameters = []
+    if job_config is not None:
+        for param in getattr(job_config, 'query_parameters', []):
+            values = tuple(param.values) if hasattr(param, 'values') else param.value
+            parameters.append((param.name, values))
+    options = tuple(sorted((name, repr(value)) for name, value in (options or {}).items()))
+    return((sql, tuple(sorted(parameters)), options))
+
+
+# BigQuery Storage Read API client shared by the batch downloads, None when
+# google-cloud-bigquery-storage is not installed
+storage_client = {}
+
+
+def StorageClient():
+    if 'client' not in storage_client:
+        try:
+            from google.cloud import bigquery_storage
+            storage_client['client'] = bigquery_storage.BigQueryReadClient()
+        except Exception:
+            storage_client['client'] = None
+    return(storage_client['client'])
+
+
+def ArrowTable(rows):
+    '''
+    Rows of a finished query as an Arrow table. BigQuery results are read
+    through the Storage Read API when it is installed (REST pages otherwise),
+    LocalQueryJob results straight from DuckDB.
+    '''
+    if hasattr(rows, 'to_arrow'):
+        return(rows.to_arrow(create_bqstorage_client=True))
+    return(pa.Table.from_pandas(rows.to_dataframe(), preserve_index=False))
+
+
+def ArrowBatches(rows):
+    '''
+    Rows of a finished query as an iterator of Arrow record batches
+    '''
+    if hasattr(rows, 'to_arrow_iterable'):
+        return(rows.to_arrow_iterable(bqstorage_client=StorageClient()))
+    return(iter(ArrowTable(rows).to_batches()))
+
+
+def ArrowFrame(table, dtypes=None):
+    '''
+    Converts an Arrow table or record batch to a DataFrame following the
+    dtype plan dtypes, a dict column -> 'category' or a numpy dtype like
+    'float32'. Category columns are dictionary encoded in Arrow, so the
+    strings are never materialized as Python objects, and get sorted
+    categories.
+    '''
+    if dtypes:
+        columns = []
+        for name, column in zip(table.column_names, table.columns):
+            dtype = dtypes.get(name)
+            if dtype == 'category':
+                if not pa.types.is_dictionary(column.type):
+                    column = pc.dictionary_encode(column)
+            elif dtype is not None:
+                column = pc.cast(column, pa.from_numpy_dtype(np.dtype(dtype)), safe=False)
+            columns.append(column)
+        table = pa.Table.from_arrays(columns, names=table.column_names)
+    data = table.to_pandas(split_blocks=True)
+    for name, dtype in (dtypes or {}).items():
+        if dtype == 'category' and name in data:
+            #sorted categories, so the rows sort as the strings would
+            data[name] = data[name].cat.reorder_categories(data[name].cat.categories.sort_values())
+    return(data)
+
+
+def FetchFrame(job, dtypes=None):
+    '''
+    job.result().to_dataframe() through Arrow with the dtype plan dtypes
+    (see ArrowFrame), e.g. {'symbol1': 'category', 'symbol2': 'category'}
+    '''
+    return(ArrowFrame(ArrowTable(job.result()), dtypes))
+
+
+def FetchBatches(job, dtypes=None):
+    '''
+    Iterator of DataFrames, one per Arrow record batch of the result, for
+    consumers that process the rows as they arrive. Category columns are
+    encoded per batch, so their categories differ between batches.
+    '''
+    for batch in ArrowBatches(job.result()):
+        yield(ArrowFrame(batch, dtypes))
+
+
+def RunShards(client, sql, shard_parameter, items, shard_size, lists=None, dtypes=None, max_concurrent=4,
+              target_seconds=None, max_shard_size=None):
+    '''
+    Runs sql once per shard of the distinct items, passed as the array
+    parameter @shard_parameter along with the array parameters in lists, at
+    most max_concurrent shards at a time, and yields the result frames
+    (FetchFrame with dtypes) as the shards finish. With target_seconds the
+    shards not started yet are sized from the observed seconds per item,
+    between half and twice the previous size.
+    '''
+    from helper import ListParameters
+
+    items = list(dict.fromkeys(items))
+    lists = lists or {}
+    size = max(1, int(shard_size))
+    if len(items) <= size:
+        yield(FetchFrame(client.query(sql, job_config=ListParameters(**dict(lists, **{shard_parameter: items}))), dtypes))
+        return
+    callers = CallPath()
+
+    def run_shard(shard):
+        query_context.callers = callers
+        try:
+            start = time.perf_counter()
+            job_config = ListParameters(**dict(lists, **{shard_parameter: shard}))
+            data = FetchFrame(client.query(sql, job_config=job_config), dtypes)
+            return(data, time.perf_counter() - start)
+        finally:
+            query_context.callers = None
+
+    position = 0
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_concurrent) as pool:
+        while position < len(items) or len(pending) > 0:
+            while position < len(items) and len(pending) < max_concurrent:
+                shard = items[position:position + size]
+                position = position + len(shard)
+                pending[pool.submit(run_shard, shard)] = len(shard)
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                n_items = pending.pop(future)
+                data, seconds = future.result()
+                if target_seconds is not None and seconds > 0:
+                    size = int(min(max(target_seconds * n_items / seconds, size / 2, 1), size * 2))
+                    if max_shard_size is not None:
+                        size = min(size, max_shard_size)
+                yield(data)
+
+
+def MergeShards(frames, by, ascending=True, dtypes=None):
+    '''
+    Concatenates the shard results of RunShards as they arrive and sorts
+    them by the by columns, as the ORDER BY of the unsharded query. The
+    category columns of dtypes get categories over all shards.
+    '''
+    frames = [data for data in frames]
+    if len(frames) == 1:
+        return(frames[0])
+    data = pd.concat(frames, ignore_index=True)
+    for name, dtype in (dtypes or {}).items():
+        if dtype == 'category' and name in data and not isinstance(data[name].dtype, pd.CategoricalDtype):
+            data[name] = data[name].astype('category')
+    return(data.sort_values(by, ascending=ascending, kind='mergesort').reset_index(drop=True))
+
+
+class QueryResult:
+    '''
+    Finished query with the result()/to_dataframe()/to_arrow() interface of a
+    QueryJob. The rows are held as one Arrow table shared by the callers of
+    deduplicated queries, every to_dataframe() call converts its own frame.
+    '''
+
+    def __init__(self, future):
+        self.future = future
+
+    def result(self):
+        self.future.result()
+        return(self)
+
+    def to_arrow(self, **kwargs):
+        return(self.future.result())
+
+    def to_dataframe(self, **kwargs):
+        return(self.future.result().to_pandas())
+
+    def done(self):
+        return(self.future.done())
+
+
+class QueryExecutor:
+    '''
+    Client wrapper that runs the queries on a thread pool: at most
+    max_concurrent jobs run at a time, transient errors are retried with
+    exponential backoff and identical queries in flight are run once.
+    client.query returns immediately, so functions called from several
+    threads with the same QueryExecutor overlap their jobs. It can be passed
+    wherever a bigquery.Client or BACKEND_operations.LocalClient is used.
+    '''
+
+    def __init__(self, client, max_concurrent=4, retries=3, backoff=1.0, retry_on=retryable_errors):
+        self.client = client
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_on = retry_on
+        self.pool = ThreadPoolExecutor(max_workers=max_concurrent)
+        self.in_flight = {}
+        self.lock = threading.RLock()
+        self.stats = {'submitted': 0, 'deduplicated': 0, 'retried': 0}
+
+    def __getattr__(self, name):
+        return(getattr(self.client, name))
+
+    def run(self, sql, job_config, callers=None, options=None):
+        query_context.callers = callers
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    return(ArrowTable(self.client.query(sql, job_config=job_config, **(options or {})).result()))
+                except self.retry_on:
+                    if attempt == self.retries:
+                        raise
+                    with self.lock:
+                        self.stats['retried'] += 1
+                    time.sleep(self.backoff * 2**attempt * (1 + random.random()))
+        finally:
+            query_context.callers = None
+
+    def forget(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    def query(self, sql, job_config=None, **kwargs):
+        key = QueryKey(sql, job_config, kwargs)
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.pool.submit(self.run, sql, job_config, CallPath(), kwargs)
+                self.in_flight[key] = future
+                self.stats['submitted'] += 1
+                future.add_done_callback(lambda f: self.forget(key, f))
+            else:
+                self.stats['deduplicated'] += 1
+        return(QueryResult(future))
+
+    def run_tasks(self, tasks):
+        '''
+        Calls function(self, *args, **kwargs) for every (function, args, kwargs)
+        in tasks on its own thread and returns the results in order. The
+        queries of all tasks share the concurrency cap.
+        '''
+        with ThreadPoolExecutor(max_workers=max(len(tasks), 1)) as callers:
+            futures = [callers.submit(function, self, *args, **kwargs) for function, args, kwargs in tasks]
+            return([future.result() for future in futures])
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+def Seconds(start, end):
+    if start is None or end is None:
+        return(None)
+    return((end - start).total_seconds())
+
+
+class TelemetryJob:
+    '''
+    Query job that records its statistics in the TelemetryClient when its
+    rows are fetched (or when it fails)
+    '''
+
+    def __init__(self, telemetry, job, record):
+        self.telemetry = telemetry
+        self.job = job
+        self.record = record
+        self.rows = None
+        self.finished = False
+
+    def __getattr__(self, name):
+        return(getattr(self.job, name))
+
+    def result(self, *args, **kwargs):
+        if self.rows is None:
+            start = time.perf_counter()
+            try:
+                self.rows = self.job.result(*args, **kwargs)
+            except Exception as error:
+                self.fail(error)
+                raise
+            self.record['wait_s'] = time.perf_counter() - start
+        return(self)
+
+    def fetch(self, download, count):
+        self.result()
+        start = time.perf_counter()
+        try:
+            data = download(self.rows)
+        except Exception as error:
+            self.fail(error)
+            raise
+        if not self.finished:
+            self.record['download_s'] = time.perf_counter() - start
+            self.record['rows'] = count(data)
+            self.finish('done')
+        return(data)
+
+    def to_dataframe(self, **kwargs):
+        return(self.fetch(lambda rows: rows.to_dataframe(**kwargs), len))
+
+    def to_arrow(self, **kwargs):
+        return(self.fetch(lambda rows: ArrowTable(rows), lambda table: table.num_rows))
+
+    def to_arrow_iterable(self, **kwargs):
+        self.result()
+        start = time.perf_counter()
+        rows = 0
+        try:
+            for batch in ArrowBatches(self.rows):
+                rows = rows + batch.num_rows
+                yield(batch)
+        except Exception as error:
+            self.fail(error)
+            raise
+        if not self.finished:
+            self.record['download_s'] = time.perf_counter() - start
+            self.record['rows'] = rows
+            self.finish('done')
+
+    def fail(self, error):
+        if not self.finished:
+            self.record['error'] = type(error).__name__ + ': ' + str(error)[:200]
+            self.finish('failed')
+
+    def finish(self, status):
+        job = self.job
+        self.record.update({
+            'status': status,
+            'job_id': getattr(job, 'job_id', None),
+            'bytes_processed': getattr(job, 'total_bytes_processed', None),
+            'bytes_billed': getattr(job, 'total_bytes_billed', None),
+            'slot_millis': getattr(job, 'slot_millis', None),
+            'cache_hit': getattr(job, 'cache_hit', None),
+            'queue_s': Seconds(getattr(job, 'created', None), getattr(job, 'started', None)),
+            'exec_s': Seconds(getattr(job, 'started', None), getattr(job, 'ended', None))})
+        self.finished = True
+        self.telemetry.add(self.record)
+
+
+class TelemetryClient:
+    '''
+    Client wrapper recording for every query the bytes processed and billed,
+    slot milliseconds, cache hit, row count, queue/execution/wait/download
+    times and the functions that issued it (see records, frame, summary and
+    export). With byte_budget, every query is first dry run and refused with
+    QueryBudgetError when it would process more than byte_budget bytes.
+    It can be passed wherever a client is used, also to run_daisy whose
+    QueryExecutor keeps the callers of the queries.
+    '''
+
+    record_columns = ['caller', 'call_path', 'sql_hash', 'status', 'job_id', 'estimated_bytes', 'bytes_processed',
+                      'bytes_billed', 'slot_millis', 'cache_hit', 'rows', 'queue_s', 'exec_s', 'wait_s',
+                      'download_s', 'submitted_at', 'error']
+
+    def __init__(self, client, byte_budget=None):
+        self.client = client
+        self.byte_budget = byte_budget
+        self.records = []
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return(getattr(self.client, name))
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def dry_run(self, sql, job_config=None):
+        '''
+        Bytes the query would process, from a dry run without the query cache
+        '''
+        from google.cloud import bigquery
+
+        config = copy.deepcopy(job_config) if job_config is not None else bigquery.QueryJobConfig()
+        config.dry_run = True
+        config.use_query_cache = False
+        return(self.client.query(sql, job_config=config).total_bytes_processed)
+
+    def query(self, sql, job_config=None, **kwargs):
+        callers = CallPath()
+        record = {'caller': callers[0] if len(callers) > 0 else None, 'call_path': ' < '.join(callers),
+                  'sql_hash': hashlib.sha1(sql.encode()).hexdigest()[:12], 'submitted_at': time.time()}
+        if self.byte_budget is not None:
+            record['estimated_bytes'] = self.dry_run(sql, job_config)
+            if record['estimated_bytes'] is not None and record['estimated_bytes'] > self.byte_budget:
+                record['status'] = 'refused'
+                self.add(record)
+                raise QueryBudgetError('Query from ' + str(record['caller']) + ' would process ' +
+                                       str(record['estimated_bytes']) + ' bytes, the budget is ' +
+                                       str(self.byte_budget) + ' bytes')
+        return(TelemetryJob(self, self.client.query(sql, job_config=job_config, **kwargs), record))
+
+    def frame(self):
+        '''
+        Records of the queries so far, one row per query
+        '''
+        with self.lock:
+            records = list(self.records)
+        return(pd.DataFrame(records, columns=self.record_columns))
+
+    def summary(self, by='caller'):
+        '''
+        Query count, bytes, slot milliseconds and times summed by the by column(s),
+        the most expensive first
+        '''
+        data = self.frame()
+        data['queries'] = 1
+        data['cache_hits'] = data['cache_hit'].fillna(False).astype(bool)
+        columns = ['queries', 'cache_hits', 'estimated_bytes', 'bytes_processed', 'bytes_billed', 'slot_millis',
+                   'rows', 'queue_s', 'exec_s', 'wait_s', 'download_s']
+        for column in columns:
+            data[column] = pd.to_numeric(data[column], errors='coerce')
+        result = data.groupby(by, dropna=False)[columns].sum(min_count=1)
+        return(result.sort_values(['bytes_billed', 'wait_s'], ascending=False))
+
+    def export(self, path):
+        '''
+        Writes the records to a .csv, .parquet or (otherwise) JSON lines file
+        '''
+        if path.endswith('.csv'):
+            self.frame().to_csv(path, index=False)
+        elif path.endswith('.parquet'):
+            self.frame().to_parquet(path, index=False)
+        else:
+            with self.lock:
+                records = list(self.records)
+            with open(path, 'w') as out:
+                for record in records:
+                    out.write(json.dumps(record, default=str) + '\n')
+
+    def reset(self):
+        with self.lock:
+            self.records = []
@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+def tscore_to_p(tscore, n, sides):
+    '''
+    Local equivalent of the jStat.ttest(tscore, n, sides) UDF used by the
+    coexpression query: the p-value of tscore with n-1 degrees of freedom
+    '''
+    tscore = np.abs(np.asarray(tscore, dtype=float))
+    n = np.asarray(n, dtype=float)
+    with np.errstate(invalid='ignore'):
+        pvalue = stats.t.sf(tscore, n - 1)
+    return(np.where(np.asarray(sides) == 1, pvalue, 2 * pvalue))
+
+
+def jstat_normal_cdf(x, mean, std):
+    '''
+    Local equivalent of `cgc-05-0042.functions.jstat_normal_cdf`
+    '''
+    return(stats.norm.cdf(np.asarray(x, dtype=float), mean, std))
+
+
+def shifted_values(values):
+    '''
+    Row means and the mean shifted values, squared values and non-NaN mask of
+    a rows x samples matrix, NaN entries set to 0. Shifting every row by its
+    mean keeps the sums of squares well conditioned.
+    '''
+    not_nan = ~np.isnan(values)
+    with np.errstate(invalid='ignore'):
+        shift = np.nanmean(np.where(not_nan.any(axis=1)[:, None], values, 0.0), axis=1)
+    centered = np.where(not_nan, values - shift[:, None], 0.0)
+    return(shift, centered, centered * centered, not_nan.astype(float))
+
+
+def merge_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    '''
+    Chan et al. parallel update: moments of the union of two disjoint parts
+    '''
+    n = n_a + n_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = mean_b - mean_a
+        mean = np.where(n_a == 0, mean_b, np.where(n_b == 0, mean_a, mean_a + delta * n_b / n))
+        m2 = np.where(n_a == 0, m2_b, np.where(n_b == 0, m2_a, m2_a + m2_b + delta * delta * n_a * n_b / n))
+    return(n, mean, m2)
+
+
+def moments(values, weights, sample_block=2048):
+    '''
+    Weighted count, mean and M2 (sum of squared deviations) of every row of
+    values (rows x samples, NaN is missing) for every column of weights
+    (samples x groups, a weight of 2 counts a sample twice).
+    The data is read once: each block of sample_block samples is shifted by its
+    row means, reduced with matrix products and merged into the running moments.
+    '''
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    n = mean = m2 = None
+    for start in range(0, max(values.shape[1], 1), sample_block):
+        block = slice(start, start + sample_block)
+        shift, centered, centered_sq, not_nan = shifted_values(values[:, block])
+        n_b = not_nan @ weights[block]
+        s1 = centered @ weights[block]
+        s2 = centered_sq @ weights[block]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_b = s1 / n_b
+            m2_b = np.maximum(s2 - s1 * mean_b, 0.0)
+        mean_b = mean_b + shift[:, None]
+        if n is None:
+            n, mean, m2 = n_b, mean_b, m2_b
+        else:
+            n, mean, m2 = merge_moments(n, mean, m2, n_b, mean_b, m2_b)
+    return(n, mean, m2)
+
+
+def ttest_from_moments(n_1, mean_1, m2_1, n_2, mean_2, m2_2, equal_var=True):
+    '''
+    t statistic, two sided p-value and Cohen's d of group 1 versus group 2
+    from their counts, means and M2. equal_var=True is Student's t-test as in
+    scipy.stats.ttest_ind, False Welch's. Cohen's d is the effect size MDSLP
+    reports: the mean difference over the population variances pooled with
+    n - 1 weights.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if equal_var:
+            dof = n_1 + n_2 - 2
+            pooled_var = (m2_1 + m2_2) / dof
+            tstat = (mean_1 - mean_2) / np.sqrt(pooled_var * (1.0/n_1 + 1.0/n_2))
+        else:
+            se2_1 = m2_1 / (n_1 - 1) / n_1
+            se2_2 = m2_2 / (n_2 - 1) / n_2
+            dof = (se2_1 + se2_2)**2 / (se2_1**2 / (n_1 - 1) + se2_2**2 / (n_2 - 1))
+            tstat = (mean_1 - mean_2) / np.sqrt(se2_1 + se2_2)
+        pvalue = 2 * stats.t.sf(np.abs(tstat), dof)
+
+        s = np.sqrt(((n_1 - 1) * (m2_1 / n_1) + (n_2 - 1) * (m2_2 / n_2)) / (n_1 + n_2 - 2))
+        es = (mean_1 - mean_2) / s
+    return(tstat, pvalue, es)
+
+
+# statsmodels names of the corrections grouped_multipletests vectorizes
+bonferroni_methods = ['b', 'bonf', 'bonferroni']
+holm_methods = ['h', 'holm']
+fdr_bh_methods = ['fdr_bh', 'fdr_i', 'fdr_p', 'fdri', 'fdrp']
+fdr_by_methods = ['fdr_by', 'fdr_n', 'fdr_c', 'fdrn', 'fdrcorr']
+
+
+def grouped_multipletests(pvalues, groups=None, method='fdr_bh', counts=None):
+    '''
+    multipletests(p, method=method)[1] of the p-values of every group, all
+    groups in one pass over one array sorted by group and p-value.
+    Bonferroni, Holm and Benjamini-Hochberg/Yekutieli are vectorized, other
+    methods call statsmodels once per group. Rows of a missing group get NaN
+    and, as in multipletests, a NaN p-value makes its whole BH/BY group NaN.
+    groups=None corrects all p-values together.
+    counts, for the vectorized methods, are the numbers of tests of the groups
+    when the rows are only the smallest p-values of their groups (as returned
+    by a significance filter in the query), the rows then get the values
+    the correction of the full groups gives them.
+    '''
+    pvalues = np.asarray(pvalues, dtype=float)
+    if groups is None:
+        codes = np.zeros(len(pvalues), dtype=int)
+    else:
+        codes = pd.factorize(pd.Series(groups))[0]
+    corrected = np.full(len(pvalues), np.nan)
+    valid = np.flatnonzero(codes >= 0)
+    #tied p-values get the same correction, so only the group sort has to be
+    #stable; small unsigned codes let it run as a radix sort
+    by_p = valid[np.argsort(pvalues[valid])]
+    group_codes = codes[by_p].astype(np.min_scalar_type(max(codes.max(initial=0), 1)))
+    order = by_p[np.argsort(group_codes, kind='stable')]
+    if len(order) == 0:
+        return(corrected)
+    p = pvalues[order]
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    if counts is None:
+        n = np.repeat(sizes, sizes).astype(float)
+    else:
+        n = np.asarray(counts, dtype=float)[order]
+    rank = np.arange(len(order)) - np.repeat(starts, sizes) + 1
+    by_group = pd.Series(sorted_codes)
+
+    method_name = method.lower()
+    if method_name in bonferroni_methods:
+        adjusted = p * n
+    elif method_name in holm_methods:
+        adjusted = pd.Series(p * (n - rank + 1)).groupby(by_group).cummax().values
+    elif method_name in fdr_bh_methods + fdr_by_methods:
+        ecdf = rank / n
+        if method_name in fdr_by_methods:
+            test_counts, count_rows = np.unique(n, return_inverse=True)
+            harmonic = np.array([np.sum(1. / np.arange(1, int(size) + 1)) for size in test_counts])
+            ecdf = ecdf / harmonic[count_rows]
+        raw = pd.Series((p / ecdf)[::-1])
+        adjusted = raw.groupby(by_group[::-1].values).cummin().values[::-1]
+        has_nan = np.repeat(np.add.reduceat(np.isnan(p), starts) > 0, sizes)
+        adjusted = np.where(has_nan, np.nan, adjusted)
+    else:
+        from statsmodels.stats.multitest import multipletests
+        for start, size in zip(starts, sizes):
+            rows = np.sort(order[start:start + size])
+            corrected[rows] = multipletests(pvalues[rows], method=method, is_sorted=False)[1]
+        return(corrected)
+    corrected[order] = np.where(adjusted > 1, 1.0, adjusted)
+    return(corrected)
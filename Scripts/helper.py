@@ -1,37 +1,47 @@
 
 from google.cloud import bigquery
 import pandas as pd
+import INDEX_operations
 
 def ConvertGene(client, input_vector, input_type, output_type):
     '''
     This function provides conversion between EntrezID, Gene and Alias
     Input type can be one of 'Alias', 'Gene', 'EntrezID'
     output type must a vector like ['Gene', 'EntrezID']
+    The conversion uses the local gene index (INDEX_operations), only its
+    first build queries gene_info_human
     '''
+    result = INDEX_operations.GetGeneIndex(client).convert(input_vector, input_type, output_type)
+    return(result)
 
 
-    sql='''
-    SELECT DISTINCT __IN_TYPE__,  __OUT_TYPE__
-    FROM  `syntheticlethality.gene_information.gene_info_human`
-    where  __IN_TYPE__  in (__IN_VECTOR__)
-    '''
-
-    if input_type=='EntrezID':
-        intermediate_representation = [str(x) for x in input_vector]
-    else:
-        intermediate_representation = ["'"+str(x)+"'" for x in input_vector]
+# SQL texts with their table, column and threshold placeholders filled in, keyed by
+# the template and its replacements. Gene, sample and tissue lists are not part of
+# the text, they are passed as array query parameters.
+compiled_queries = {}
 
-    input_vector_query= ','.join(intermediate_representation)
 
-    out_type_intermediate_representation = [str(x) for x in output_type]
-    output_type_for_query= ','.join(out_type_intermediate_representation)
+def CompileQuery(template, replacements):
+    '''
+    Replaces the (placeholder, value) pairs of replacements in template, the
+    result is cached so every configuration is compiled once per session
+    '''
+    key = (template, tuple(replacements))
+    if key not in compiled_queries:
+        sql = template
+        for placeholder, value in replacements:
+            sql = sql.replace(placeholder, value)
+        compiled_queries[key] = sql
+    return(compiled_queries[key])
 
-    sql=sql.replace('__OUT_TYPE__', output_type_for_query)
-    sql=sql.replace('__IN_TYPE__', input_type)
-    sql=sql.replace('__IN_VECTOR__', input_vector_query)
 
-    result= client.query(sql).result().to_dataframe()
-    return(result)
+def ListParameters(**lists):
+    '''
+    Query job configuration passing every keyword list as a STRING array
+    parameter, used in the queries as UNNEST(@name)
+    '''
+    parameters = [bigquery.ArrayQueryParameter(name, "STRING", [str(x) for x in values]) for name, values in lists.items()]
+    return(bigquery.QueryJobConfig(query_parameters=parameters))
 
 
 def WriteToExcel(excel_file, data_to_write, excel_tab_names):